@@ -0,0 +1,84 @@
+import sys
+
+class AttributeValueDictionary:
+   """Dictionary encoding of attribute values
+   Chado exports repeat long attribute values (product terms, GO and controlled curation strings, db_xref lists...)
+   on thousands of features.  encode_feature() can be passed to gffutils as a transform when importing, to replace
+   each such value with a short code; there is then one (interned) copy of each distinct value in memory,
+   while the gffutils db holds only the codes, plus a table of the values written by save().
+   decode_feature() restores the original values, e.g. before a feature is written as GFF3."""
+
+   # codes start with a character that won't occur in attribute values, followed by the index into the table of values
+   code_prefix          = '\x1f'
+   # shorter values aren't worth encoding, as the code (JSON escaped, in the db) is about this long
+   min_value_length     = 12
+   # name of the table the values are saved to in the gffutils db
+   db_table             = 'gffmunger_attribute_values'
+   # attributes whose values are never encoded, as gffutils (when creating relations) and the munge commands
+   # read them directly from the db
+   relation_attributes  = ['ID', 'Parent', 'Derives_from']
+
+   def __init__(self, not_encoded=[]):
+      """Optionally pass list of attributes whose values should not be encoded, in addition to relation_attributes"""
+      self.not_encoded  = set(self.relation_attributes) | set(not_encoded)
+      self.values       = []  # value, by code number
+      self.codes        = {}  # value -> code
+      self.num_saved    = 0   # number of values already written to the db table
+
+   def encode(self, value):
+      """Returns the code for a value, adding it to the dictionary if it's new; short values are returned unchanged"""
+      if len(value) < self.min_value_length:
+         return(value)
+      try:
+         return(self.codes[value])
+      except KeyError:
+         code = self.code_prefix + str(len(self.values))
+         self.values.append( sys.intern(value) )
+         self.codes[self.values[-1]] = code
+         return(code)
+
+   def decode(self, value):
+      """Returns the value a code stands for; anything that isn't a code is returned unchanged"""
+      if value.startswith(self.code_prefix):
+         return( self.values[int(value[1:])] )
+      return(value)
+
+   def encode_feature(self, feature):
+      """Pass gffutils.Feature; encodes its attribute values in place, and returns it (for use as a gffutils transform)"""
+      self.encode_attributes(feature.attributes)
+      return(feature)
+
+   def encode_attributes(self, attributes):
+      """Pass attributes (gffutils.Attributes, or dict of attribute -> list of values); encodes the values in place"""
+      for key in list(attributes.keys()):
+         if not key in self.not_encoded:
+            attributes[key] = [ self.encode(value) for value in attributes[key] ]
+
+   def decode_feature(self, feature):
+      """Pass gffutils.Feature; decodes its attribute values in place, and returns it"""
+      for key in feature.attributes.keys():
+         if not key in self.not_encoded:
+            feature.attributes[key] = [ self.decode(value) for value in feature.attributes[key] ]
+      return(feature)
+
+   def save(self, conn):
+      """Pass connection to the gffutils db; writes any values not already saved to the table of values"""
+      conn.execute("CREATE TABLE IF NOT EXISTS "+self.db_table+" (code INTEGER PRIMARY KEY, value TEXT NOT NULL)")
+      conn.executemany( "INSERT INTO "+self.db_table+" (code, value) VALUES (?, ?)",
+                        [ (code, self.values[code]) for code in range(self.num_saved, len(self.values)) ]
+                        )
+      conn.commit()
+      self.num_saved = len(self.values)
+
+   @classmethod
+   def load(cls, conn, not_encoded=[]):
+      """Pass connection to a gffutils db to which values were saved by save()
+      Returns AttributeValueDictionary holding those values"""
+      dictionary = cls(not_encoded)
+      for code, value in conn.execute("SELECT code, value FROM "+cls.db_table+" ORDER BY code"):
+         if code != len(dictionary.values):
+            raise ValueError("Table of attribute values in gffutils db is missing code "+str(len(dictionary.values)))
+         dictionary.values.append( sys.intern(value) )
+         dictionary.codes[dictionary.values[-1]] = cls.code_prefix + str(code)
+      dictionary.num_saved = len(dictionary.values)
+      return(dictionary)
@@ -0,0 +1,89 @@
+import struct
+import zlib
+
+class BGZFReader:
+   """Random access reader for a BGZF (blocked gzip) file
+   seek() and tell() use virtual offsets (offset of the compressed block << 16 | offset within the
+   uncompressed block), as recorded in a tabix index.  Lines are returned as text, without decoding
+   any blocks other than those they span."""
+
+   def __init__(self, filename):
+      self.filename        = filename
+      self.handle          = open(filename, 'rb')
+      self.block_offset    = 0      # compressed offset of the current block
+      self.next_offset     = 0      # compressed offset of the following block
+      self.block           = b''    # uncompressed data of the current block
+      self.within_block    = 0
+
+   def __enter__(self):
+      return(self)
+
+   def __exit__(self, *args):
+      self.close()
+
+   def close(self):
+      if self.handle is not None:
+         self.handle.close()
+         self.handle = None
+
+   @staticmethod
+   def is_bgzf(filename):
+      """Returns True if the file starts with a BGZF block header"""
+      try:
+         with open(filename, 'rb') as f:
+            header = f.read(16)
+      except Exception:
+         return(False)
+      return( len(header) == 16 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:16] == b'BC\x02\x00' )
+
+   def load_block(self, block_offset):
+      """Reads and decompresses the block at block_offset
+      Returns False at end of file"""
+      self.handle.seek(block_offset)
+      header = self.handle.read(18)
+      if len(header) < 18:
+         self.block        = b''
+         self.block_offset = self.next_offset = block_offset
+         return(False)
+      if header[:4] != b'\x1f\x8b\x08\x04' or header[12:16] != b'BC\x02\x00':
+         raise ValueError("Not a BGZF block at offset "+str(block_offset)+" in "+self.filename)
+      bsize             = struct.unpack('<H', header[16:18])[0] + 1
+      cdata             = self.handle.read(bsize - 18)
+      self.block        = zlib.decompress(cdata[:-8], -15)
+      self.block_offset = block_offset
+      self.next_offset  = block_offset + bsize
+      return(True)
+
+   def seek(self, virtual_offset):
+      """Moves to a virtual offset"""
+      block_offset = virtual_offset >> 16
+      if block_offset != self.block_offset or not self.block:
+         self.load_block(block_offset)
+      self.within_block = virtual_offset & 0xffff
+
+   def tell(self):
+      """Returns the virtual offset of the next character to be read"""
+      if self.within_block >= len(self.block) and self.block:
+         return( self.next_offset << 16 )
+      return( self.block_offset << 16 | self.within_block )
+
+   def readline(self):
+      """Returns the next line (including the newline), or an empty string at the end of the file"""
+      line = b''
+      while True:
+         if self.within_block >= len(self.block):
+            # skip empty blocks (such as the EOF marker) until some data is found
+            while True:
+               if not self.load_block(self.next_offset):
+                  return( line.decode('utf-8') )
+               if self.block:
+                  break
+            self.within_block = 0
+         newline = self.block.find(b'\n', self.within_block)
+         if newline < 0:
+            line             += self.block[self.within_block:]
+            self.within_block = len(self.block)
+         else:
+            line             += self.block[self.within_block:newline+1]
+            self.within_block = newline+1
+            return( line.decode('utf-8') )
@@ -0,0 +1,133 @@
+import collections
+import concurrent.futures
+import struct
+import zlib
+
+class BGZFWriter:
+   """Writes text to a BGZF (blocked gzip) file, as produced by bgzip and required by tabix
+   BGZF is a series of gzip members, each holding at most 64KiB of uncompressed data, so the result
+   can be read by anything that reads gzip.  Each position in the file has a 'virtual offset'
+   (offset of the compressed block << 16 | offset within the uncompressed block) which is what an
+   index such as tabix records.
+   As each block is independent, blocks can be compressed in parallel:  pass threads > 1 to compress
+   on a thread pool (zlib releases the GIL, so this scales with cores); blocks are still written in order.
+   As the compressed size of a block isn't known until it has been compressed, position() returns a
+   position as a block number (rather than offset) << 16 | offset within block; pass this to
+   virtual_offset() once the block has been written (e.g. after close()) to get the virtual offset."""
+
+   # htslib never puts more than this much uncompressed data in a block
+   # (leaves room for the compressed data to be a bit bigger than the input, and still fit in 64KiB)
+   max_block_size    = 0xff00
+
+   # the empty block that marks the end of a BGZF file
+   eof_block         = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+   def __init__(self, filename, compresslevel=6, threads=1):
+      self.filename           = filename
+      self.compresslevel      = compresslevel
+      self.threads            = threads
+      self.handle             = open(filename, 'wb')
+      self.buffer             = bytearray()
+      self.block_number       = 0      # number of the block currently being filled
+      self.block_offsets      = []     # compressed offset of each block written
+      self.compressed_offset  = 0      # compressed offset of the next block to be written
+      self.executor           = None
+      self.pending            = collections.deque() # futures of blocks being compressed, in file order
+      if threads > 1:
+         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+   def __enter__(self):
+      return(self)
+
+   def __exit__(self, *args):
+      self.close()
+
+   def write(self, text):
+      """Write a string (encoded as UTF-8) to the file"""
+      self.write_bytes( text.encode('utf-8') )
+      return(len(text))
+
+   def write_bytes(self, data):
+      """Write binary data to the file"""
+      data  = memoryview(data)
+      pos   = 0
+      while pos < len(data):
+         space = self.max_block_size - len(self.buffer)
+         self.buffer.extend( data[pos:pos+space] )
+         pos  += space
+         # flush as soon as the block is full, so a position never points at the end of a full block
+         if len(self.buffer) >= self.max_block_size:
+            self.flush()
+
+   def position(self):
+      """Returns position of the next character to be written, as block number << 16 | offset within block
+      (use virtual_offset() to convert this to a virtual offset)"""
+      return( self.block_number << 16 | len(self.buffer) )
+
+   def virtual_offset(self, position):
+      """Pass a position returned by position(); the block it's in must have been written (or be the next to be written)
+      Returns the virtual offset"""
+      block_number = position >> 16
+      if block_number < len(self.block_offsets):
+         block_offset = self.block_offsets[block_number]
+      elif block_number == len(self.block_offsets):
+         block_offset = self.compressed_offset
+      else:
+         raise ValueError("Can't get the virtual offset of block "+str(block_number)+" until it has been written")
+      return( block_offset << 16 | position & 0xffff )
+
+   def tell(self):
+      """Returns the virtual offset of the next character to be written
+      (this waits for any blocks being compressed, so when using threads, use position() instead)"""
+      self.write_pending(0)
+      return( self.virtual_offset(self.position()) )
+
+   def flush(self):
+      """Compresses whatever is in the buffer and writes it as a BGZF block
+      (when using threads, the block is queued for compression, and written later)"""
+      if not self.buffer:
+         return
+      data        = bytes(self.buffer)
+      self.buffer = bytearray()
+      if self.executor is None:
+         self.write_block( self.compress_block(data, self.compresslevel) )
+      else:
+         self.pending.append( self.executor.submit(self.compress_block, data, self.compresslevel) )
+         # limit the number of blocks queued, so memory use is bounded
+         self.write_pending(2 * self.threads)
+      self.block_number += 1
+
+   def write_pending(self, max_pending):
+      """Writes compressed blocks in order, until no more than max_pending are left queued"""
+      while self.pending and (len(self.pending) > max_pending or self.pending[0].done()):
+         self.write_block( self.pending.popleft().result() )
+
+   def write_block(self, block):
+      self.block_offsets.append(self.compressed_offset)
+      self.handle.write(block)
+      self.compressed_offset += len(block)
+
+   def close(self):
+      """Flushes any buffered data and writes the BGZF EOF marker"""
+      if self.handle is None:
+         return
+      self.flush()
+      self.write_pending(0)
+      if self.executor is not None:
+         self.executor.shutdown()
+         self.executor = None
+      self.handle.write(self.eof_block)
+      self.handle.close()
+      self.handle = None
+
+   @staticmethod
+   def compress_block(data, compresslevel=6):
+      """Pass up to max_block_size bytes of data
+      Returns a complete BGZF block (gzip member with the BC extra subfield giving the block size)"""
+      compressor  = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+      cdata       = compressor.compress(data) + compressor.flush()
+      # header is 18 bytes, trailer 8; BSIZE is total block size minus 1
+      bsize       = len(cdata) + 25
+      header      = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize)
+      trailer     = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+      return(header + cdata + trailer)
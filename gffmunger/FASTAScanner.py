@@ -0,0 +1,202 @@
+import collections
+import concurrent.futures
+import gzip
+import struct
+import zlib
+
+from gffmunger.BGZFReader import BGZFReader
+
+class FASTAScanner:
+   """Validates a FASTA file, and builds its faidx index, in a single streaming pass
+   The file may be plain, gzipped or BGZF compressed.  Every record is checked:  the header must have an ID (with no
+   space between it and the '>'), IDs must be unique, sequence may only contain characters in the alphabet, and all
+   the lines of a sequence must be the same length, except the last, which may be shorter (as required for faidx).
+   As records are read, the .fai index (and, for BGZF, the .gzi index of blocks) is built, so pyfaidx need not read
+   the file again.
+   Lines aren't checked one at a time:  each run of sequence lines is checked with a few operations on the whole
+   run (bytes.translate() for the alphabet, and strided slices for the line lengths).  Reading and decompressing
+   are done on other threads, ahead of the checks; BGZF blocks are decompressed on a pool of threads."""
+
+   # size of the chunks read from plain or gzipped files
+   chunk_size = 4 * 1024 * 1024
+
+   def __init__(self, filename, alphabet='ACGTURYSWKMBDHVN-', threads=1):
+      """Pass path of FASTA file, string of characters allowed in sequences (in either case), and number of
+      threads to decompress BGZF blocks on"""
+      self.filename       = filename
+      self.threads        = max(1, threads)
+      self.alphabet       = alphabet
+      self.sequence_chars = (alphabet.upper()+alphabet.lower()+"\r\n").encode('ascii')
+      self.is_bgzf        = BGZFReader.is_bgzf(filename)
+      self.errors         = []     # error messages
+      self.index          = []     # faidx record for each sequence: [ID, length, offset, line bases, line width]
+      self.gzi            = []     # BGZF blocks (other than the first): (compressed offset, uncompressed offset)
+      self.ids            = set()
+      self.record         = None
+      self.line_number    = 0      # number of lines read so far
+
+   def scan(self):
+      """Reads the whole file, validating each record and building the index
+      Returns True if the file is valid FASTA; if not, the problems found are in self.errors"""
+      offset         = 0   # uncompressed offset of the start of data
+      partial_line   = []  # chunks (or end of a chunk) with no newline yet; a long sequence may be on one line
+      for chunk in self.chunks():
+         # only complete lines are processed; any partial line is kept for the next chunk
+         end_of_lines = chunk.rfind(b'\n') + 1
+         if not end_of_lines:
+            partial_line.append(chunk)
+            continue
+         data           = b''.join(partial_line + [chunk[:end_of_lines]])
+         partial_line   = [chunk[end_of_lines:]]
+         self.read_lines(data, len(data), offset)
+         offset        += len(data)
+      data = b''.join(partial_line)
+      if data:
+         # last line had no newline
+         self.read_lines(data+b'\n', len(data)+1, offset)
+      self.end_record()
+      if not self.index and not self.errors:
+         self.error("no FASTA records found")
+      return(not self.errors)
+
+   def error(self, message):
+      self.errors.append(self.filename+" line "+str(self.line_number)+": "+message)
+
+   def chunks(self):
+      """Generator yielding the (uncompressed) content of the file, in chunks read ahead on other threads"""
+      with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+         pending = collections.deque()
+         if self.is_bgzf:
+            for block_data in self.bgzf_blocks(executor, pending):
+               yield(block_data)
+            return
+         if self.filename.endswith('.gz'):
+            handle = gzip.open(self.filename, 'rb')
+         else:
+            handle = open(self.filename, 'rb')
+         with handle:
+            # reads must be in order, so only read one chunk ahead
+            pending.append( executor.submit(handle.read, self.chunk_size) )
+            while True:
+               chunk = pending.popleft().result()
+               if not chunk:
+                  return
+               pending.append( executor.submit(handle.read, self.chunk_size) )
+               yield(chunk)
+
+   def bgzf_blocks(self, executor, pending):
+      """Generator yielding the data in each BGZF block, decompressed on the executor's threads"""
+      compressed_offset    = 0
+      uncompressed_offset  = 0
+      with open(self.filename, 'rb') as handle:
+         while True:
+            header = handle.read(18)
+            if len(header) < 18:
+               break
+            if header[:4] != b'\x1f\x8b\x08\x04' or header[12:16] != b'BC\x02\x00':
+               raise ValueError("Not a BGZF block at offset "+str(compressed_offset)+" in "+self.filename)
+            bsize = struct.unpack('<H', header[16:18])[0] + 1
+            cdata = handle.read(bsize - 18)
+            # uncompressed size is in the trailer, so the index can be built without waiting for decompression
+            block_size = struct.unpack('<I', cdata[-4:])[0]
+            if compressed_offset > 0 and block_size > 0:
+               self.gzi.append( (compressed_offset, uncompressed_offset) )
+            compressed_offset    += bsize
+            uncompressed_offset  += block_size
+            pending.append( executor.submit(zlib.decompress, cdata[:-8], -15) )
+            while len(pending) > 4 * self.threads:
+               yield( pending.popleft().result() )
+      while pending:
+         yield( pending.popleft().result() )
+
+   def read_lines(self, data, end, offset):
+      """Pass data, the index of the end of its last complete line, and the file offset of the start of data
+      Processes headers and runs of sequence lines in data[:end]"""
+      pos = 0
+      while pos < end:
+         if data[pos] == 62: # '>'
+            newline = data.find(b'\n', pos)
+            self.line_number += 1
+            self.start_record( data[pos+1:newline].rstrip(b'\r').decode('utf-8', 'replace'), offset+newline+1 )
+            pos = newline+1
+            continue
+         # sequence runs to the next header
+         next_header = data.find(b'\n>', pos, end)
+         run_end     = end if next_header < 0 else next_header+1
+         self.sequence_lines(data[pos:run_end])
+         pos = run_end
+
+   def start_record(self, header, offset):
+      """Pass FASTA header (without the '>') and the offset of the start of the record's sequence"""
+      self.end_record()
+      this_id = header.split(None, 1)[0] if header and not header[0].isspace() else None
+      if this_id is None:
+         self.error("FASTA header has no ID")
+      elif this_id in self.ids:
+         self.error("duplicate FASTA ID "+this_id)
+      else:
+         self.ids.add(this_id)
+      self.record = { 'id': this_id, 'length': 0, 'offset': offset, 'line_bases': None, 'line_width': None, 'ended': False }
+
+   def end_record(self):
+      if self.record is not None and self.record['id'] is not None:
+         self.index.append( [ self.record['id'], self.record['length'], self.record['offset'],
+                              self.record['line_bases'] or 0, self.record['line_width'] or 0 ] )
+      self.record = None
+
+   def sequence_lines(self, lines):
+      """Pass a run of complete lines of sequence (from a single record); checks them, and updates the record"""
+      first_line_number  = self.line_number+1
+      self.line_number  += lines.count(b'\n')
+      body = lines.rstrip(b'\r\n')
+      if not body:
+         # blank lines; allowed only at the end of a record
+         if self.record is not None:
+            self.record['ended'] = True
+         return
+      if self.record is None:
+         self.error("sequence found before the first FASTA header")
+         return
+      record = self.record
+      if record['ended']:
+         self.error("sequence "+str(record['id'])+" has a blank or short line before line "+str(self.line_number))
+         record['ended'] = False
+      invalid = body.translate(None, self.sequence_chars)
+      if invalid:
+         self.error("sequence "+str(record['id'])+" contains characters not in the alphabet: "+repr(bytes(sorted(set(invalid))).decode('ascii', 'replace')))
+      # line length is set by the first line of the record
+      if record['line_bases'] is None:
+         first_newline        = lines.find(b'\n')
+         terminator_length    = 2 if first_newline > 0 and lines[first_newline-1] == 13 else 1
+         record['line_bases'] = len(lines[:first_newline].rstrip(b'\r'))
+         record['line_width'] = record['line_bases'] + terminator_length
+      line_bases  = record['line_bases']
+      line_width  = record['line_width']
+      # all but the last line should be exactly line_width long: so the newlines should be every line_width bytes
+      num_lines   = body.count(b'\n') + 1
+      full_lines  = num_lines - 1
+      last_line   = len(body) - full_lines * line_width
+      newlines    = body[line_width-1::line_width][:full_lines]
+      consistent  = newlines == b'\n' * full_lines and 0 < last_line <= line_bases
+      if consistent and line_width - line_bases == 2:
+         consistent = body[line_width-2::line_width][:full_lines] == b'\r' * full_lines
+      if not consistent:
+         self.error("sequence "+str(record['id'])+" has lines of different lengths between lines "+str(first_line_number)+" and "+str(self.line_number))
+      record['length'] += len(body) - full_lines * (line_width - line_bases)
+      # a short last line, or blank lines after the sequence, must be the end of the record
+      if last_line < line_bases or len(lines) - len(body) > line_width - line_bases:
+         record['ended'] = True
+
+   def write_fai(self, fai_filename=None):
+      """Writes the faidx index; by default to the FASTA file name with .fai appended
+      For BGZF, also writes the .gzi index of blocks"""
+      if fai_filename is None:
+         fai_filename = self.filename+'.fai'
+      with open(fai_filename, 'w') as f:
+         for record in self.index:
+            f.write( "\t".join([str(field) for field in record])+"\n" )
+      if self.is_bgzf:
+         with open(self.filename+'.gzi', 'wb') as f:
+            f.write( struct.pack('<Q', len(self.gzi)) )
+            for compressed_offset, uncompressed_offset in self.gzi:
+               f.write( struct.pack('<QQ', compressed_offset, uncompressed_offset) )
@@ -0,0 +1,34 @@
+import json
+import os
+
+from gffmunger.FeatureSnapshotWriter import FeatureSnapshotWriter, numpy
+
+class FeatureSnapshotReader:
+   """Memory mapped snapshot written by FeatureSnapshotWriter; columns are attributes holding numpy arrays (nothing is
+   read until used), and the methods below decode the dictionary encoded columns and attributes of one feature"""
+
+   def __init__(self, directory):
+      if numpy is None:
+         raise ImportError("numpy is required to read a feature snapshot")
+      with open(os.path.join(directory, FeatureSnapshotWriter.json_filename)) as f:
+         header = json.load(f)
+      if header['format_version'] != FeatureSnapshotWriter.format_version:
+         raise ValueError("Feature snapshot in "+directory+" is format version "+str(header['format_version'])+
+                          ", expected "+str(FeatureSnapshotWriter.format_version))
+      self.directory    = directory
+      self.num_features = header['num_features']
+      for column in FeatureSnapshotWriter.array_columns:
+         setattr(self, column, numpy.load(os.path.join(directory, column+'.npy'), mmap_mode='r'))
+      for column in FeatureSnapshotWriter.dict_columns:
+         setattr(self, column+'_values', numpy.load(os.path.join(directory, column+'_values.npy'), mmap_mode='r'))
+
+   def __len__(self):
+      return(self.num_features)
+
+   def decoded(self, column, n):
+      """Pass name of a dictionary encoded column (seqid, source or featuretype) and feature number; returns value"""
+      return( str( getattr(self, column+'_values')[ getattr(self, column)[n] ] ) )
+
+   def feature_attributes(self, n):
+      """Pass feature number; returns its attributes, as GFF3 column 9 text"""
+      return( bytes( self.attributes[ self.attribute_offsets[n]:self.attribute_offsets[n+1] ] ).decode('utf-8') )
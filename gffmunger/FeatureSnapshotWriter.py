@@ -0,0 +1,88 @@
+import array
+import json
+import os
+
+# numpy is only needed for snapshots, so it's optional
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+class FeatureSnapshotWriter:
+   """Columnar binary snapshot of features, for downstream analysis without re-parsing GFF3
+   A snapshot is a directory of NumPy .npy files, one per column, which FeatureSnapshotReader memory maps, so
+   opening a snapshot reads nothing but the (small) headers, however many features there are:
+   - start, end:                    int64
+   - score:                         float64 (NaN where the score is '.')
+   - strand:                        1 byte character ('+', '-', '.' or '?')
+   - phase:                         int8 (-1 where the phase is '.')
+   - seqid, source, featuretype:    uint32 codes, indexing seqid_values, source_values, featuretype_values
+   - attributes:                    uint8 blob of the attributes (column 9 of the GFF3, UTF-8 encoded), one
+                                    feature after another; feature n is attributes[attribute_offsets[n]:attribute_offsets[n+1]]
+   plus snapshot.json, holding the format version and number of features.
+   Features are added one at a time, and kept in compact arrays until write() is called."""
+
+   format_version = 1
+   json_filename  = 'snapshot.json'
+   # columns written to a snapshot
+   dict_columns   = ['seqid', 'source', 'featuretype']
+   array_columns  = ['start', 'end', 'score', 'strand', 'phase', 'attribute_offsets', 'attributes'] + dict_columns
+
+   def __init__(self):
+      if numpy is None:
+         raise ImportError("numpy is required to write a feature snapshot")
+      self.num_features       = 0
+      self.start              = array.array('q')
+      self.end                = array.array('q')
+      self.score              = array.array('d')
+      self.strand             = bytearray()
+      self.phase              = array.array('b')
+      self.attributes         = bytearray()
+      self.attribute_offsets  = array.array('q', [0])
+      # dictionary encoded columns: codes, and value -> code
+      self.codes              = { column: array.array('L') for column in self.dict_columns }
+      self.values             = { column: {}               for column in self.dict_columns }
+
+   @staticmethod
+   def available():
+      """Returns True if numpy (needed to read or write snapshots) can be imported"""
+      return( numpy is not None )
+
+   def encode(self, column, value):
+      return( self.values[column].setdefault(value, len(self.values[column])) )
+
+   def add(self, feature, line=None):
+      """Pass gffutils.Feature to add to the snapshot, and optionally the feature as a GFF3 line
+      (to save it being written again, if the caller has already done so)"""
+      if line is None:
+         line = str(feature)
+      self.codes['seqid'].append(       self.encode('seqid',       feature.seqid) )
+      self.codes['source'].append(      self.encode('source',      feature.source) )
+      self.codes['featuretype'].append( self.encode('featuretype', feature.featuretype) )
+      self.start.append( feature.start )
+      self.end.append( feature.end )
+      self.score.append( float('nan') if feature.score in ['.', '', None] else float(feature.score) )
+      self.strand.extend( (feature.strand or '.')[0].encode('ascii') )
+      self.phase.append( -1 if feature.frame in ['.', '', None] else int(feature.frame) )
+      self.attributes.extend( line.rstrip('\n').split('\t', 8)[8].encode('utf-8') )
+      self.attribute_offsets.append( len(self.attributes) )
+      self.num_features += 1
+
+   def write(self, directory):
+      """Writes the snapshot to directory (which is created if need be)"""
+      os.makedirs(directory, exist_ok=True)
+      columns = { 'start':             numpy.frombuffer(self.start,              dtype=numpy.int64),
+                  'end':               numpy.frombuffer(self.end,                dtype=numpy.int64),
+                  'score':             numpy.frombuffer(self.score,              dtype=numpy.float64),
+                  'strand':            numpy.frombuffer(bytes(self.strand),      dtype='S1'),
+                  'phase':             numpy.frombuffer(self.phase,              dtype=numpy.int8),
+                  'attribute_offsets': numpy.frombuffer(self.attribute_offsets,  dtype=numpy.int64),
+                  'attributes':        numpy.frombuffer(bytes(self.attributes),  dtype=numpy.uint8),
+                  }
+      for column in self.dict_columns:
+         columns[column]           = numpy.array(self.codes[column], dtype=numpy.uint32)
+         columns[column+'_values'] = numpy.array(list(self.values[column]), dtype=str)
+      for column, values in columns.items():
+         numpy.save( os.path.join(directory, column+'.npy'), values )
+      with open(os.path.join(directory, self.json_filename), 'w') as f:
+         json.dump( { 'format_version': self.format_version, 'num_features': self.num_features }, f )
@@ -0,0 +1,122 @@
+import collections
+
+class FeatureTraversal:
+   """Runs any number of munge commands in a single traversal of a gffutils db, with a single write-back
+   Each command registers transforms:
+   - per-feature transforms, optionally restricted to some feature types, are called with each feature
+   - per-cluster transforms are called with each cluster of features related by Parent attributes (a top level
+     feature, such as a gene, and all its descendants), once every feature in the cluster has been read
+   Transforms are called as transform(feature, traversal) or transform(cluster, traversal), in the order they
+   were registered.  A transform changes features in place and passes each one it changes to traversal.modified().
+   Features changed by one transform are seen, as changed, by transforms called later, so a transform that looks
+   up a related feature in the db should pass it to current() to get the latest version.
+   After the traversal, each command's finish function (if any) is called, then all changed features are written
+   back to the db in one go."""
+
+   def __init__(self, db, order_by=None):
+      self.db                 = db
+      self.order_by           = order_by
+      self.feature_transforms = []  # (featuretypes or None, transform)
+      self.cluster_transforms = []
+      self.finishers          = []
+      self.modified_features  = collections.OrderedDict()  # id -> Feature; dicts aren't ordered in Python 3.5
+
+   def register(self, transform, featuretypes=None, finish=None):
+      """Pass function to be called with each feature, optional list of the feature types it applies to
+      (default is all), and optional function to be called with the traversal once it's complete"""
+      self.feature_transforms.append( (None if featuretypes is None else set(featuretypes), transform) )
+      if finish is not None:
+         self.finishers.append(finish)
+
+   def register_cluster(self, transform, finish=None):
+      """Pass function to be called with each cluster (list of features, in traversal order), and optional
+      function to be called with the traversal once it's complete"""
+      self.cluster_transforms.append(transform)
+      if finish is not None:
+         self.finishers.append(finish)
+
+   def modified(self, feature):
+      """Pass a feature that a transform has changed; it'll be written back to the db after the traversal"""
+      self.modified_features[feature.id] = feature
+
+   def current(self, feature):
+      """Pass a feature; returns the version changed by an earlier transform, if there is one, otherwise the feature"""
+      return( self.modified_features.get(feature.id, feature) )
+
+   def clusters(self):
+      """Returns dict mapping the ID of each feature that has a parent or children to the ID of its cluster, and
+      dict of the number of features in each cluster; read from the db's relations, not the features"""
+      cluster_of = {}
+      # union-find, as a feature may have more than one parent
+      def find(this_id):
+         root = this_id
+         while cluster_of[root] != root:
+            root = cluster_of[root]
+         while cluster_of[this_id] != root:
+            cluster_of[this_id], this_id = root, cluster_of[this_id]
+         return(root)
+      for parent, child in self.db.conn.execute("SELECT parent, child FROM relations WHERE level = 1"):
+         cluster_of.setdefault(parent, parent)
+         cluster_of.setdefault(child, child)
+         parent_cluster = find(parent)
+         child_cluster  = find(child)
+         if parent_cluster != child_cluster:
+            cluster_of[child_cluster] = parent_cluster
+      cluster_size = {}
+      for this_id in cluster_of:
+         cluster_of[this_id] = find(this_id)
+         cluster_size[cluster_of[this_id]] = cluster_size.get(cluster_of[this_id], 0) + 1
+      return(cluster_of, cluster_size)
+
+   def traverse(self):
+      """Returns iterator over each feature that needs to be read, in order; if only per-feature transforms restricted
+      to some feature types were registered, only features of those types are read"""
+      featuretypes = set()
+      for these_featuretypes, transform in self.feature_transforms:
+         if these_featuretypes is None:
+            featuretypes = None
+            break
+         featuretypes |= these_featuretypes
+      if featuretypes is None or self.cluster_transforms:
+         return( self.db.all_features(order_by=self.order_by) )
+      if not featuretypes:
+         return( iter([]) )
+      return( self.db.features_of_type(sorted(featuretypes), order_by=self.order_by) )
+
+   def run(self):
+      """Runs all registered transforms in a single traversal, calls finish functions, and writes changed features
+      back to the db
+      Returns list of IDs of changed features"""
+      if self.cluster_transforms:
+         cluster_of, cluster_size = self.clusters()
+      open_clusters = {}
+      def run_cluster(cluster):
+         features = [ self.current(this_feature) for this_feature in cluster ]
+         for transform in self.cluster_transforms:
+            transform(features, self)
+            features = [ self.current(this_feature) for this_feature in features ]
+      for this_feature in self.traverse():
+         this_feature = self.current(this_feature)
+         for featuretypes, transform in self.feature_transforms:
+            if featuretypes is None or this_feature.featuretype in featuretypes:
+               transform(this_feature, self)
+               this_feature = self.current(this_feature)
+         if self.cluster_transforms:
+            this_cluster = cluster_of.get(this_feature.id)
+            if this_cluster is None:
+               run_cluster( [this_feature] )
+               continue
+            open_clusters.setdefault(this_cluster, []).append(this_feature)
+            if len(open_clusters[this_cluster]) == cluster_size[this_cluster]:
+               run_cluster( open_clusters.pop(this_cluster) )
+      # clusters with features missing from the db (e.g. a relation to an ID that doesn't exist)
+      for this_cluster in list(open_clusters):
+         run_cluster( open_clusters.pop(this_cluster) )
+      for finish in self.finishers:
+         finish(self)
+      # write back: remove the old versions of all the changed features from the db, and insert the new ones
+      modified = list(self.modified_features.values())
+      if modified:
+         self.db.delete( modified )
+         self.db.update( modified )
+      return( list(self.modified_features.keys()) )
@@ -1,23 +1,40 @@
+import copy
 import gffutils
+import gffutils.bins
 import gzip
+import hashlib
+import json
 import logging
 import os
 import re
 import subprocess
 import sys
 import time
+import urllib.parse
 import uuid
 import warnings
 import yaml
 
-from Bio import SeqIO
 from pyfaidx import Fasta
 
+from gffmunger.AttributeValueDictionary import AttributeValueDictionary
+from gffmunger.BGZFReader import BGZFReader
+from gffmunger.BGZFWriter import BGZFWriter
+from gffmunger.FASTAScanner import FASTAScanner
+from gffmunger.FeatureSnapshotWriter import FeatureSnapshotWriter
+from gffmunger.FeatureTraversal import FeatureTraversal
+from gffmunger.ParallelGFFDBCreator import ParallelGFFDBCreator
+from gffmunger.TabixIndex import TabixIndex
+
 class GFFMunger:
 
    def __init__(self,options):
 
-      self.known_commands = ['move_polypeptide_annot', 'null']
+      self.known_commands = ['move_polypeptide_annot', 'relation_report', 'diff', 'null']
+      # commands that don't change the features; if only these are given, no GFF3 is written
+      self.report_only_commands = ['relation_report', 'diff']
+      # commands that read GFF3 files as text; if only these are given, the input isn't imported into gffutils
+      self.text_only_commands = ['diff']
 
       # CLI options
       if None == options:
@@ -33,6 +50,12 @@ class GFFMunger:
          self.output_file     = 'no_such_file'
          self.config_file     = 'gffmunger-config.yml'
          self.gt_path_arg     = None
+         self.tabix_index     = None
+         self.region          = None
+         self.report_file     = None
+         self.patch_export    = False
+         self.diff_file       = None
+         self.snapshot_dir    = None
       else:
          # this should be the normal case
          self.commands        = options.commands
@@ -45,6 +68,12 @@ class GFFMunger:
          self.output_file     = options.output_file
          self.config_file     = options.config
          self.gt_path_arg     = options.genometools
+         self.tabix_index     = options.tabix
+         self.region          = options.region
+         self.report_file     = options.report_file
+         self.patch_export    = options.patch
+         self.diff_file       = options.diff_file
+         self.snapshot_dir    = options.snapshot
 
       # set up logger
       self.logger = logging.getLogger(__name__)
@@ -79,6 +108,11 @@ class GFFMunger:
          return( str(config_value).lower() == 'true' )
       try:
          self.keep_attr_value_order       = config_value_is_true(self.config['keep_attr_value_order'])
+         self.encode_attr_values          = config_value_is_true(self.config['encode_attr_values'])
+         self.compression_threads         = int(self.config['compression_threads']) or os.cpu_count() or 1
+         self.import_processes            = int(self.config['import_processes']) or os.cpu_count() or 1
+         self.fasta_alphabet              = str(self.config['fasta_alphabet'])
+         self.fasta_scan_threads          = int(self.config['fasta_scan_threads']) or os.cpu_count() or 1
          self.attr_not_transferred        = self.config['attr_not_transferred']
          self.output_feature_sort         = self.config['output_feature_sort']
          self.annotated_feature_types     = self.config['annotated_feature_types']
@@ -88,11 +122,18 @@ class GFFMunger:
          self.gff3_valiation_timeout      = self.config['gff3_validation_timeout']
          self.gffutils_db_filename        = str(self.config['gffutils_db_filename']).replace('<uid>',uuid.uuid4().hex)
          self.read_features_to_buffer     = config_value_is_true(self.config['read_features_to_buffer'])
+         self.region_index_suffix         = self.config['region_index_suffix']
+         self.prescan_ids                 = config_value_is_true(self.config['prescan_ids'])
       except KeyError as e:
          self.logger.critical("required parameter "+str(e)+" missing from configuration in "+self.config_file)
          raise
       config_fh.close()
       
+      # dictionary of encoded attribute values; created when GFF3 is imported, if encode_attr_values is set
+      self.attribute_values = None
+      # IDs of features changed by munge commands; used when exporting in patch mode
+      self.modified_feature_ids = set()
+
       # apply any environment vaiables that override config file params
       if 'GENOMETOOLS_PATH' in os.environ:
          self.gt_path_env_var = os.environ['GENOMETOOLS_PATH']
@@ -140,6 +181,44 @@ class GFFMunger:
             self.output_file = None
          self.logger.debug("Writing output to STDOUT")
 
+      if self.region:
+         if not self.input_file_arg:
+            self.logger.critical("A region can only be munged when reading input from a file, as the input must be indexed")
+            sys.exit(1)
+         self.logger.info("Munging only features related to region "+self.region_string(self.region))
+         if not self.fasta_file_arg:
+            self.logger.info("FASTA in the input GFF3 won't be written when munging a region; use --fasta-file to include sequence in the output")
+
+      if self.tabix_index:
+         if self.output_file is None or not self.output_file.endswith('.gz'):
+            self.logger.critical("Tabix indexed output must be written to a file with a .gz suffix")
+            sys.exit(1)
+         self.logger.info("Writing BGZF compressed output with a ."+self.tabix_index+" index")
+
+      if self.patch_export:
+         if self.tabix_index or self.region:
+            self.logger.critical("Patch mode output copies the whole input, in input order, so can't be used with --tabix or --region")
+            sys.exit(1)
+         self.logger.info("Writing output in patch mode: only lines of modified features will be changed")
+
+      if self.snapshot_dir:
+         if not FeatureSnapshotWriter.available():
+            self.logger.critical("Writing a feature snapshot requires numpy, which can't be imported")
+            sys.exit(1)
+         if not self.force and os.path.exists(self.snapshot_dir):
+            self.logger.critical("The snapshot directory already exists, please choose another name: "+ self.snapshot_dir)
+            sys.exit(1)
+         self.logger.info("Writing feature snapshot to "+ self.snapshot_dir)
+
+      if 'diff' in self.commands:
+         if self.diff_file:
+            if not os.path.exists(self.diff_file):
+               self.logger.critical("File to compare with the input does not exist: "+ self.diff_file)
+               sys.exit(1)
+         elif self.output_file is None or self.is_report_only():
+            self.logger.critical("diff compares the input with --diff-file, or with the GFF3 output file if one is written")
+            sys.exit(1)
+
 
 
    def run(self):
@@ -147,30 +226,60 @@ class GFFMunger:
          # get GFF3 input, stdin or file; sets self.gff3_input_filename
          self.get_gff3_source() 
          # validate GFF3 if required
-         if not self.novalidate:
+         # (not when munging a region, as the point is to avoid reading the whole input)
+         if not self.novalidate and not self.region:
             self.validate_GFF3(self.gff3_input_filename)
-         # import GFF3
-         self.import_gff3(self.gff3_input_filename)
-         # if FASTA is being read from separate file...
-         if self.fasta_file_arg:
-            # ...validate if required...
-            if not self.novalidate:
-               self.validate_FASTA(self.fasta_file_arg)
-            # ...and import
-            self.import_fasta(self.fasta_file_arg)
-         # read GFF3 metadta (and poss. other bits) into text buffer(s)
-         self.extract_GFF3_components(self.gff3_input_filename)
-
-         if 'move_polypeptide_annot' in self.commands:
-            self.logger.info('transferring polypeptide feature annotations')
-            # transfer annotations from polypeptide features to the feature they derived from
-            self.move_polypeptide_annotations()
-
-         # write new GFF3 to file or stdout
-         self.export_gff3()
-         # if GFF3 file was written, validate it if required
-         if self.output_file is not None and not self.novalidate:
-            self.validate_GFF3(self.output_file)
+         # reports from all the commands that produce them, written together at the end
+         report = {}
+         # commands such as diff read the GFF3 files as text, so if there are no others, nothing is imported
+         if not self.is_text_only():
+            # quick scan of IDs and references, so problems are reported before the (much slower) import
+            if self.prescan_ids and not self.region:
+               self.prescan_gff3(self.gff3_input_filename)
+            # import GFF3; either all of it, or features related to the region
+            if self.region:
+               self.import_gff3_region(self.gff3_input_filename, self.region)
+            else:
+               self.import_gff3(self.gff3_input_filename)
+            # if FASTA is being read from separate file...
+            if self.fasta_file_arg:
+               # ...validate if required...
+               if not self.novalidate:
+                  self.validate_FASTA(self.fasta_file_arg)
+               # ...and import
+               self.import_fasta(self.fasta_file_arg)
+               self.check_fasta_seqids()
+            # read GFF3 metadta (and poss. other bits) into text buffer(s)
+            self.extract_GFF3_components(self.gff3_input_filename)
+
+            if 'relation_report' in self.commands:
+               self.logger.info('reporting problems with polypeptide relations')
+               report.update( self.relation_report() )
+
+            # munge commands register their transforms, then all are run in a single traversal of the db
+            traversal = FeatureTraversal(self.gffutils_db, order_by=self.output_feature_sort)
+            if 'move_polypeptide_annot' in self.commands:
+               self.logger.info('transferring polypeptide feature annotations')
+               # transfer annotations from polypeptide features to the feature they derived from
+               self.move_polypeptide_annotations(traversal)
+            self.modified_feature_ids.update( traversal.run() )
+
+            # when only reporting, nothing has changed, so there's no need to write GFF3
+            if not self.is_report_only():
+               # write new GFF3 to file or stdout
+               self.export_gff3()
+               # if GFF3 file was written, validate it if required
+               if self.output_file is not None and not self.novalidate:
+                  self.validate_GFF3(self.output_file)
+
+         # compare the input with another GFF3 file, or else the output just written
+         if 'diff' in self.commands:
+            diff_filename = self.diff_file or self.output_file
+            self.logger.info('comparing features in '+self.gff3_input_filename+' with '+diff_filename)
+            report.update( self.diff_gff3(self.gff3_input_filename, diff_filename) )
+
+         if report:
+            self.write_report(report, self.report_file)
 
       except Exception:
          self.clean_up()
@@ -180,6 +289,18 @@ class GFFMunger:
 
 
 
+   def is_report_only(self):
+      """Returns True if none of the commands change the features (so GFF3 output isn't needed)"""
+      return( all( [c in self.report_only_commands for c in self.commands] ) )
+
+
+
+   def is_text_only(self):
+      """Returns True if all of the commands read GFF3 files as text (so the input needn't be imported)"""
+      return( all( [c in self.text_only_commands for c in self.commands] ) )
+
+
+
    def clean_up(self):
       if hasattr(self, 'temp_input_file') and self.temp_input_file and os.path.exists(self.temp_input_file):
          self.logger.debug("Deleting temporary input buffer "+ self.temp_input_file)
@@ -266,42 +387,299 @@ class GFFMunger:
 
    def validate_FASTA(self, fasta_filename, silent=False): 
       """Validates FASTA file.
-      Pass path of FASTA file; if valid, True is returned; if invalid, validator STDERR output is printed and False is returned
+      Pass path of FASTA file (plain, gzipped or BGZF); if valid, True is returned; if invalid, the problems found are
+      printed and False is returned.  Every record is checked, in a single pass (see FASTAScanner), and if the file is
+      valid its .fai index (and .gzi, if BGZF) is written as it's read, so import_fasta() won't read the file again.
       Validation failure message printed to STDOUT; this can be supressed by passing the optional flag 'silent'"""
       self.logger.info("Validating FASTA file "+ fasta_filename)
       if self.logger.isEnabledFor(logging.INFO):
          print("*** logging INFO ***")
-      with self.open_text_file(fasta_filename) as handle:
-         fasta = SeqIO.parse(handle, "fasta")
-         is_fasta = any(fasta)   # False when `fasta` is empty, i.e. wasn't a FASTA file
-         if not is_fasta and not silent:
-            print(fasta_filename+" is not a valid FASTA file")
+      scanner  = FASTAScanner(fasta_filename, alphabet=self.fasta_alphabet, threads=self.fasta_scan_threads)
+      is_fasta = scanner.scan()
+      if not is_fasta:
+         if not silent:
+            print(fasta_filename+" is not a valid FASTA file:")
+            print("\n".join(scanner.errors))
+         return(is_fasta)
+      # pyfaidx can read plain or BGZF FASTA, but not gzip
+      if scanner.is_bgzf or not fasta_filename.endswith('.gz'):
+         try:
+            scanner.write_fai()
+         except OSError as e:
+            self.logger.info("Couldn't write FASTA index for "+fasta_filename+" ("+str(e)+"); pyfaidx will build it")
+      self.logger.info("validated "+str(len(scanner.index))+" FASTA sequences")
       return(is_fasta)
 
 
 
+   def prescan_gff3(self, gff_filename=None, silent=False):
+      """Optionally pass path of GFF3 file; otherwise this is retrieved using get_gff3_source()
+      Streams through the features, reading only the ID, Parent and Derives_from attributes, to find
+      duplicate IDs and references to IDs that don't exist.  Any problems are logged as a single report.
+      This is quick compared to import_gff3(), which would fail on the first duplicate ID (and broken
+      relations would otherwise only be found one at a time while munging).
+      Returns dict with 'duplicate_ids' (ID -> list of line numbers) and 'dangling_references' (list of
+      (line number, attribute, ID) tuples).  Raises ValueError if there are duplicate IDs, as the GFF3 can't
+      be imported; the optional flag 'silent' suppresses logging of the report."""
+      if not gff_filename:
+         gff_filename = self.get_gff3_source()
+      self.logger.debug("Scanning IDs and references in GFF3 file "+ gff_filename)
+      first_line_of_id  = {}
+      duplicate_ids     = {}
+      references        = []
+      with self.open_text_file(gff_filename) as f:
+         for linenum, line in enumerate(f, 1):
+            if line.startswith('#'):
+               if line.startswith('##FASTA'):
+                  break
+               continue
+            if line.startswith('>'):
+               break
+            columns = line.rstrip('\n').split('\t', 8)
+            if len(columns) < 9:
+               continue
+            for this_attribute in columns[8].split(';'):
+               key, sep, value = this_attribute.partition('=')
+               if 'ID' == key:
+                  if value in first_line_of_id:
+                     duplicate_ids.setdefault(value, [first_line_of_id[value]]).append(linenum)
+                  else:
+                     first_line_of_id[value] = linenum
+               elif key in ['Parent', 'Derives_from']:
+                  for this_id in value.split(','):
+                     references.append( (linenum, key, this_id) )
+      dangling_references = [ reference for reference in references if not reference[2] in first_line_of_id ]
+      if not silent and (duplicate_ids or dangling_references):
+         report = [ "Scan of "+gff_filename+" found "+str(len(duplicate_ids))+" duplicate IDs and "+
+                    str(len(dangling_references))+" references to IDs that don't exist:" ]
+         for this_id, linenums in duplicate_ids.items():
+            report.append("   ID "+this_id+" occurs on lines "+", ".join([str(n) for n in linenums]))
+         for linenum, key, this_id in dangling_references:
+            report.append("   "+key+" "+this_id+" on line "+str(linenum)+" doesn't match any ID")
+         self.logger.error("\n".join(report))
+      self.logger.info("scanned "+str(len(first_line_of_id))+" IDs and "+str(len(references))+" references")
+      if duplicate_ids:
+         raise ValueError("GFF3 file "+gff_filename+" has "+str(len(duplicate_ids))+" duplicate IDs, so can't be imported")
+      return( { 'duplicate_ids': duplicate_ids, 'dangling_references': dangling_references } )
+
+
+
    def import_gff3(self, gff_filename=None):
       """Optionally path of GFF3 file; otherwise this is retrieved using get_gff3_source()
       Imports GFF3 from the file into gffutils"""
       if not gff_filename:
          gff_filename = self.get_gff3_source()
       self.logger.debug("Importing using gffutils, from GFF3 file "+ gff_filename)
+      self.gffutils_db = self.create_gffutils_db(gff_filename, self.gffutils_db_filename, encode=self.encode_attr_values)
+      return(self.gffutils_db_filename)
+
+
+
+   def create_gffutils_db(self, data, db_filename, from_string=False, encode=False):
+      """Pass GFF3 file name (or GFF3 text, if from_string is True), and name of the db file
+      Creates and returns a gffutils db, with the options used for all gffmunger imports
+      A file is parsed on import_processes processes (see ParallelGFFDBCreator), creating the same db as gffutils would.
+      If the optional flag 'encode' is passed, annotation attribute values are dictionary encoded
+      (see AttributeValueDictionary); the dictionary is stored as self.attribute_values, and saved in the db"""
+      transform            = None
+      transform_attributes = None
+      if encode:
+         self.attribute_values   = AttributeValueDictionary()
+         transform               = self.attribute_values.encode_feature
+         transform_attributes    = self.attribute_values.encode_attributes
       with warnings.catch_warnings():
          if not self.verbose:
             warnings.filterwarnings("ignore", "unclosed file <_io\.TextIOWrapper",  ResourceWarning,           "gffutils", 133 )
             warnings.filterwarnings("ignore", "generator '_FileIterator\.",         PendingDeprecationWarning, "gffutils", 186 )
             warnings.filterwarnings("ignore", "unclosed file <_io\.TextIOWrapper",  ResourceWarning,           "gffutils", 668 )
-         self.gffutils_db = gffutils.create_db( gff_filename,
-                                                dbfn                    = self.gffutils_db_filename,
-                                                force                   = True,     # overwrite previous testing db file
-                                                merge_strategy          = 'error',
-                                                keep_order              = self.keep_attr_value_order,
-                                                sort_attribute_values   = False
-                                                )
+         if from_string:
+            db = gffutils.create_db(   data,
+                                       dbfn                    = db_filename,
+                                       force                   = True,     # overwrite previous testing db file
+                                       merge_strategy          = 'error',
+                                       keep_order              = self.keep_attr_value_order,
+                                       sort_attribute_values   = False,
+                                       from_string             = from_string,
+                                       transform               = transform
+                                       )
+         else:
+            self.logger.debug("Parsing GFF3 on "+str(self.import_processes)+" processes")
+            db = ParallelGFFDBCreator.create_db(   data,
+                                                   db_filename,
+                                                   processes               = self.import_processes,
+                                                   force                   = True,
+                                                   keep_order              = self.keep_attr_value_order,
+                                                   sort_attribute_values   = False,
+                                                   transform_attributes    = transform_attributes
+                                                   )
+      if encode:
+         self.attribute_values.save(db.conn)
+         self.logger.info("encoded "+str(len(self.attribute_values.values))+" distinct attribute values")
+      return(db)
+
+
+
+   def region_string(self, region):
+      """Pass (seqid, start, end) tuple; returns it formatted as seqid[:start-end]"""
+      seqid, start, end = region
+      if start is None:
+         return(seqid)
+      return(seqid+':'+str(start)+'-'+str(end))
+
+
+
+   def import_gff3_region(self, gff_filename=None, region=None):
+      """Optionally pass path of GFF3 file (otherwise this is retrieved using get_gff3_source()) and region
+      as (seqid, start, end) tuple (otherwise self.region is used); start and end are 1-based, inclusive,
+      and may be None to take the whole sequence.
+      Imports into gffutils only the features overlapping the region, plus all the features related to them
+      via Parent or Derives_from attributes, read using an index of the input file (see region_fetcher())
+      so the time taken depends on the size of the region rather than the size of the input."""
+      if not gff_filename:
+         gff_filename = self.get_gff3_source()
+      if region is None:
+         region = self.region
+      self.logger.debug("Importing using gffutils, features related to region "+self.region_string(region)+" of GFF3 file "+ gff_filename)
+      fetch, find_parents  = self.region_fetcher(gff_filename)
+      lines                = self.features_related_to_region(fetch, *region, find_parents=find_parents)
+      if not lines:
+         self.logger.critical("No features found in region "+self.region_string(region)+" of "+gff_filename)
+         # SystemExit isn't caught by run(), so clean up here
+         self.clean_up()
+         sys.exit(1)
+      self.logger.info("importing "+str(len(lines))+" features related to region "+self.region_string(region))
+      self.gffutils_db = self.create_gffutils_db("\n".join(lines)+"\n", self.gffutils_db_filename, from_string=True, encode=self.encode_attr_values)
       return(self.gffutils_db_filename)
 
 
 
+   def region_fetcher(self, gff_filename):
+      """Pass path of GFF3 file
+      Returns a function fetch(seqid, start, end), which returns list of lines of features overlapping the region
+      (start and end may be None to fetch the whole sequence), and a function find_parents(ids), which returns the
+      set of those IDs that are the Parent of another feature; find_parents is None if the index can't tell.
+      If the input is BGZF compressed with a tabix index (.tbi or .csi) alongside, lines are read from the
+      input file using that index.  Otherwise a gffutils db of the whole input is created alongside the input,
+      with the suffix region_index_suffix from the config; this is reused by later runs unless the input is
+      modified, and features are found in it using the db's bin index."""
+      for index_format in ['tbi', 'csi']:
+         index_filename = gff_filename+'.'+index_format
+         if os.path.exists(index_filename) and BGZFReader.is_bgzf(gff_filename):
+            self.logger.debug("Reading region using tabix index "+ index_filename)
+            tabix_index = TabixIndex.read(index_filename)
+            reader      = BGZFReader(gff_filename)
+            def fetch_with_tabix(seqid, start, end):
+               if start is None:
+                  start, end = 1, tabix_index.max_position()
+               return( list(tabix_index.fetch(reader, seqid, start, end)) )
+            return(fetch_with_tabix, None)
+      region_db = self.region_index_db(gff_filename)
+      def fetch_with_db(seqid, start, end):
+         if start is None:
+            rows = region_db.conn.execute("SELECT id FROM features WHERE seqid = ? ORDER BY rowid", (seqid,))
+         else:
+            region_bins = list(gffutils.bins.bins(int(start), int(end), one=False))
+            rows = region_db.conn.execute( "SELECT id FROM features WHERE seqid = ? AND start <= ? AND end >= ? AND bin IN ("
+                                           + ",".join(["?"] * len(region_bins)) + ") ORDER BY rowid",
+                                           tuple([seqid, int(end), int(start)] + region_bins)
+                                           )
+         return( [ str(region_db[row[0]]) for row in rows.fetchall() ] )
+      def find_parents_with_db(ids):
+         ids = list(ids)
+         if not ids:
+            return(set())
+         rows = region_db.conn.execute( "SELECT DISTINCT parent FROM relations WHERE level = 1 AND parent IN ("
+                                        + ",".join(["?"] * len(ids)) + ")", tuple(ids) )
+         return( set( [ row[0] for row in rows.fetchall() ] ) )
+      return(fetch_with_db, find_parents_with_db)
+
+
+
+   def region_index_db(self, gff_filename):
+      """Pass path of GFF3 file
+      Returns the gffutils db used as an index for reading regions of the file, creating it if it doesn't
+      exist or is older than the GFF3 file"""
+      db_filename = gff_filename + self.region_index_suffix
+      if os.path.exists(db_filename) and os.path.getmtime(db_filename) >= os.path.getmtime(gff_filename):
+         self.logger.debug("Using existing region index "+ db_filename)
+         return( gffutils.FeatureDB(db_filename, keep_order=self.keep_attr_value_order) )
+      self.logger.info("Creating region index "+ db_filename+" (this will be reused for subsequent regions)")
+      return( self.create_gffutils_db(gff_filename, db_filename) )
+
+
+
+   def features_related_to_region(self, fetch, seqid, start, end, find_parents=None):
+      """Pass function for fetching lines of features in a region (as returned by region_fetcher()), the
+      region's seqid, start and end, and optionally function for finding which IDs are parents (likewise)
+      Returns list of the lines of all features overlapping the region, plus those related to them via Parent
+      or Derives_from attributes, in input order.
+      Related features lie within the extent of the features they relate to, so the region is widened to
+      cover the features related to those overlapping the original region, until no more are found.  Features
+      that are unrelated to those found so far are kept if they overlap the original region, but only widen it
+      if they may have children:  so a chromosome, contig or gap feature with no children doesn't cause the whole
+      sequence to be read.  Without find_parents, any feature with an ID is assumed to be a possible parent."""
+      def columns(line):
+         return( line.split('\t', 8) )
+      def related_lines(lines, region_lines):
+         """Returns set of the indices of lines reachable from region_lines via Parent or Derives_from, list of
+         the indices of each line's relatives, and dict of ID attributes (as in the GFF3) -> index"""
+         # index ID attributes, and the IDs each feature refers to
+         owner_of_id = {}
+         references  = []
+         for n, line in enumerate(lines):
+            references.append([])
+            for this_attribute in columns(line)[8].split(';'):
+               key, sep, value = this_attribute.partition('=')
+               if 'ID' == key:
+                  owner_of_id[value] = n
+               elif key in ['Parent', 'Derives_from']:
+                  references[n].extend( value.split(',') )
+         # features are related if either refers to the other
+         related = [ [] for line in lines ]
+         for n, ids in enumerate(references):
+            for this_id in ids:
+               if this_id in owner_of_id:
+                  related[n].append(owner_of_id[this_id])
+                  related[owner_of_id[this_id]].append(n)
+         # everything reachable from features overlapping the region
+         in_region   = set(region_lines)
+         to_visit    = [ n for n, line in enumerate(lines) if line in in_region ]
+         keep        = set(to_visit)
+         while to_visit:
+            for m in related[to_visit.pop()]:
+               if not m in keep:
+                  keep.add(m)
+                  to_visit.append(m)
+         return(keep, related, owner_of_id)
+      region_lines   = fetch(seqid, start, end)
+      lines          = region_lines
+      keep, related, owner_of_id = related_lines(lines, region_lines)
+      if start is not None:
+         span        = (int(start), int(end))
+         is_parent   = {}  # ID -> whether it's a parent; saves asking find_parents again as the region widens
+         while keep:
+            # features with no relatives found yet only widen the region if they may have children
+            widening       = [ n for n in keep if related[n] ]
+            unrelated_ids  = [ this_id for this_id, n in owner_of_id.items() if n in keep and not related[n] ]
+            if find_parents is not None:
+               unknown = [ this_id for this_id in unrelated_ids if not this_id in is_parent ]
+               if unknown:
+                  found = find_parents( [ urllib.parse.unquote(this_id) for this_id in unknown ] )
+                  is_parent.update( [ (this_id, urllib.parse.unquote(this_id) in found) for this_id in unknown ] )
+               unrelated_ids = [ this_id for this_id in unrelated_ids if is_parent[this_id] ]
+            widening.extend( [ owner_of_id[this_id] for this_id in unrelated_ids ] )
+            new_span = ( min( [span[0]] + [ int(columns(lines[n])[3]) for n in widening ] ),
+                         max( [span[1]] + [ int(columns(lines[n])[4]) for n in widening ] ),
+                         )
+            if new_span == span:
+               break
+            span  = new_span
+            lines = fetch(seqid, *span)
+            keep, related, owner_of_id = related_lines(lines, region_lines)
+      return( [ line for n, line in enumerate(lines) if n in keep ] )
+
+
+
    def import_fasta(self, fasta_filename=None):
       """Optionally path of FASTA file; otherwise use self.fasta_file_arg
       Imports FASTA from the file using pyfaidx.Fasta"""
@@ -310,6 +688,18 @@ class GFFMunger:
       self.logger.debug("Importing FASTA using pyfaidx.Fasta, from "+ fasta_filename)
       self.faidx = Fasta(fasta_filename)
       return(self.faidx)
+
+
+
+   def check_fasta_seqids(self):
+      """Checks every seqid in the gffutils db has a sequence in the FASTA imported by import_fasta()
+      Returns list of seqids with no sequence; these are logged as an error, as their sequence can't be written"""
+      missing_seqids = [ row[0] for row in self.gffutils_db.conn.execute("SELECT DISTINCT seqid FROM features ORDER BY seqid")
+                                if not row[0] in self.faidx ]
+      if missing_seqids:
+         self.logger.error("The GFF3 input has features on "+str(len(missing_seqids))+" sequences not found in the FASTA input "+
+                           self.fasta_file_arg+": "+", ".join(missing_seqids))
+      return(missing_seqids)
       
       
       
@@ -370,8 +760,9 @@ class GFFMunger:
                # everything that isn't a comment, and occurs before the first FASTA line, is a feature
                # => this is a feature
                # if features aren't being read into a buffer, and the FASTA is being read from a separate file,
-               # we can bale out right here
-               if not self.read_features_to_buffer and self.fasta_file_arg:
+               # we can bale out right here; likewise if only a region is being munged, as neither the features
+               # nor the FASTA come from reading the whole input
+               if self.region or (not self.read_features_to_buffer and self.fasta_file_arg):
                   self.logger.debug("finished reading GFF3 file at the end of the metadata")
                   return(linenum-1)
                found_first_feature = True
@@ -394,19 +785,36 @@ class GFFMunger:
 
 
 
-   def move_polypeptide_annotations(self):
-      """moves annotations from the polypeptide feature to the feature from which it derives (e.g. mRNA)"""
-      num_polypeptide=0
-      # this list caches all modified Feature objects
-      # so they can be used to update the db after the gffutils_db.features_of_type iterator is finished
-      modified_feature_cache=[]
-      for this_polypeptide in self.gffutils_db.features_of_type('polypeptide'):
+   def move_polypeptide_annotations(self, traversal=None):
+      """moves annotations from the polypeptide feature to the feature from which it derives (e.g. mRNA)
+      Optionally pass a FeatureTraversal, with which the move will be registered, to be run along with any other
+      commands when the traversal is run; otherwise the move is run immediately, on its own traversal"""
+      run_now = traversal is None
+      if run_now:
+         traversal = FeatureTraversal(self.gffutils_db, order_by=self.output_feature_sort)
+      num_polypeptide      = 0
+      annotated_features   = []
+      annotated_from       = {}  # ID of each annotated feature -> ID of the polypeptide its annotations came from
+
+      def move_annotations(this_polypeptide, traversal):
+         nonlocal num_polypeptide
          num_polypeptide+=1
          
          this_derives_from_feature = self.get_derives_from_feature(this_polypeptide)
          # return value of None indicates polypeptide shoukld be ignored, but it's safe to continue
          if this_derives_from_feature is None:
-            continue
+            return
+         # use the version of the feature changed by an earlier transform, if there is one
+         this_derives_from_feature = traversal.current(this_derives_from_feature)
+         # if several polypeptides derive from one feature, moving the annotations of each would overwrite those
+         # already moved; so only the first polypeptide's are moved, and the rest keep theirs
+         if this_derives_from_feature.id in annotated_from:
+            self.logger.error("Polypeptide %s derives from %s, which already has the annotations of polypeptide %s: cannot transfer its annotations",
+                              this_polypeptide.id,
+                              this_derives_from_feature.id,
+                              annotated_from[this_derives_from_feature.id],
+                              )
+            return
          
          # log warning if the returned feature type is not one expected to be annotated
          if not this_derives_from_feature.featuretype in self.annotated_feature_types:
@@ -416,51 +824,46 @@ class GFFMunger:
                                 this_derives_from_feature.featuretype,
                                 )
          
-         # create new set of attributes for the Derives_from feature
-         # these are a copy of those from the polypeptide (hence transferring annotations)...
-         self.logger.debug("copying annotations to feature from which polypeptide derives "+this_derives_from_feature.attributes.get('ID')[0])
-         new_derives_from_feature_attributes = dict(this_polypeptide.attributes) # returns copy of this_polypeptide.attributes
-         # ...except those attributes that shouldn't be transferred
-         for not_copied in self.attr_not_transferred:
-            if not_copied in new_derives_from_feature_attributes:
-               del new_derives_from_feature_attributes[not_copied]
-            if not_copied in this_derives_from_feature.attributes:
-               new_derives_from_feature_attributes[not_copied] = this_derives_from_feature.attributes.get(not_copied)
-         # assign new attributes to Derives_from feature
-         this_derives_from_feature.attributes = new_derives_from_feature_attributes
-         # cache the ammended Feature object
-         modified_feature_cache.append(this_derives_from_feature)
-         
-         # create new set of attributes for the polypeptide feature
-         self.logger.debug("removing annotations from polypeptide feature "+this_polypeptide.attributes.get('ID')[0])
+         # the polypeptide's attributes are moved (not copied) to the Derives_from feature (hence transferring annotations)...
+         self.logger.debug("moving annotations from polypeptide feature "+this_polypeptide.attributes.get('ID')[0]+
+                           " to feature from which it derives "+this_derives_from_feature.attributes.get('ID')[0])
+         transferred_attributes     = this_polypeptide.attributes
          new_polypeptide_attributes = {}
-         # make a copy of all attributes that aren't to be transferred to the Derives_from feature
-         for preserved_attribute in self.attr_not_transferred:
-            if preserved_attribute in this_polypeptide.attributes:
-               new_polypeptide_attributes[preserved_attribute] = this_polypeptide.attributes.get(preserved_attribute)
-         # assign the new attribites to the polypeptide feature
-         this_polypeptide.attributes = new_polypeptide_attributes
-         # cache the ammended polypeptide Feature object
-         modified_feature_cache.append(this_polypeptide)
-                  
-      self.logger.info("found "+str(num_polypeptide)+" polypeptide features")
-      if self.logger.isEnabledFor(logging.INFO):
-         print("*** logging INFO ***")
-      
-      self.check_for_anotations(modified_feature_cache)
-      
-      # remove the old versions of all the ammended features from the db
-      self.gffutils_db.delete( modified_feature_cache )
-      # insert the ammended features into the db
-      ## (this wee generator exists only to allow the logging whilst iterating through the Feature objects)
-      #def iterate_over_modified_features(cache):
-         #for this_feature in cache:
-            #self.logger.debug("modifying "+this_feature.attributes.get('ID')[0]+" in gffutils db")
-            #yield this_feature
-      #self.gffutils_db.update( iterate_over_modified_features(modified_feature_cache) )
-      self.gffutils_db.update( modified_feature_cache )
+         # ...except those attributes that shouldn't be transferred, which stay with the polypeptide
+         # (and the Derives_from feature keeps its own values of these)
+         for not_transferred in self.attr_not_transferred:
+            if not_transferred in transferred_attributes:
+               new_polypeptide_attributes[not_transferred] = transferred_attributes.pop(not_transferred)
+            if not_transferred in this_derives_from_feature.attributes:
+               transferred_attributes[not_transferred] = this_derives_from_feature.attributes.get(not_transferred)
+         # assign new attributes to Derives_from feature, and the polypeptide
+         this_derives_from_feature.attributes   = transferred_attributes
+         this_polypeptide.attributes            = new_polypeptide_attributes
+         # the ammended Feature objects are written back to the db after the traversal
+         traversal.modified(this_derives_from_feature)
+         traversal.modified(this_polypeptide)
+         annotated_features.append(this_derives_from_feature)
+         annotated_from[this_derives_from_feature.id] = this_polypeptide.id
+
+      def finish(traversal):
+         self.logger.info("found "+str(num_polypeptide)+" polypeptide features")
+         if self.logger.isEnabledFor(logging.INFO):
+            print("*** logging INFO ***")
+         self.check_for_anotations(annotated_features)
+
+      traversal.register(move_annotations, featuretypes=['polypeptide'], finish=finish)
+      if run_now:
+         self.modified_feature_ids.update( traversal.run() )
+
 
-      del modified_feature_cache # may be big
+
+   def feature_string(self, feature):
+      """Pass gffutils.Feature
+      Returns the feature as a GFF3 line, with any dictionary encoded attribute values decoded (for log and
+      error messages); the feature itself isn't changed"""
+      if self.attribute_values is None:
+         return( str(feature) )
+      return( str(self.attribute_values.decode_feature(copy.deepcopy(feature))) )
 
 
 
@@ -474,14 +877,14 @@ class GFFMunger:
       Only raises exception on encountering a something so unexpected that we can't safely continue."""
       # ignore polypeptide, with warning, if 'Derives_from' is missing
       if not 'Derives_from' in polypeptide_feature.attributes:
-         self.logger.error("Ignoring polypeptide feature without a Derives_from attribute:\n"+str(polypeptide_feature)+"\n")
+         self.logger.error("Ignoring polypeptide feature without a Derives_from attribute:\n"+self.feature_string(polypeptide_feature)+"\n")
          return(None)
       # get the polypeptide ID
       num_polypeptide_ID = 0
       for polypeptide_ID in polypeptide_feature.attributes.get('ID'):
          num_polypeptide_ID += 1
       if not 1 == num_polypeptide_ID:
-         raise AssertionError("polypeptide "+polypeptide_ID+" must have exactly one 'ID' attribute, found "+str(num_polypeptide_ID)+" in feature line"+str(polypeptide_feature))
+         raise AssertionError("polypeptide "+polypeptide_ID+" must have exactly one 'ID' attribute, found "+str(num_polypeptide_ID)+" in feature line "+self.feature_string(polypeptide_feature))
       # get the Derives_from attribute (asserting presence of single Derives_from attribute)
       num_derives_from = 0
       for derives_from in polypeptide_feature.attributes.get('Derives_from'):
@@ -514,7 +917,7 @@ class GFFMunger:
             num_id += 1
          # assert one only ID
          if not 1 == num_id:
-            raise AssertionError("a feature must have exactly one 'ID' attribute, found "+str(num_id)+" in feature line "+str(this_child))
+            raise AssertionError("a feature must have exactly one 'ID' attribute, found "+str(num_id)+" in feature line "+self.feature_string(this_child))
          # check for match
          if this_child_ID == derives_from:
             num_matches += 1
@@ -546,36 +949,356 @@ class GFFMunger:
    
    
    
+   def relation_report(self):
+      """Finds all the problems with polypeptide relations that get_derives_from_feature() and check_for_anotations()
+      would find one at a time while munging, in a single pass over the features and relations in the gffutils db.
+      Returns dict of error class -> list of problems, each a dict with 'feature' (ID), 'related' (ID of
+      related feature, or None) and 'detail'.  The error classes are:
+      - missing_derives_from:    polypeptide has no Derives_from attribute
+      - polypeptide_id_count:    polypeptide doesn't have exactly one ID
+      - derives_from_count:      polypeptide doesn't have exactly one Derives_from value
+      - derives_from_not_found:  Derives_from refers to a feature that doesn't exist
+      - parent_count:            feature the polypeptide derives from doesn't have exactly one parent
+      - multiple_polypeptides:   more than one polypeptide derives from the same feature
+      - unexpected_type:         polypeptide derives from a type not in annotated_feature_types
+      - not_annotated:           feature of a type in annotated_feature_types has no polypeptide deriving from it
+      (get_derives_from_feature() also checks Derives_from matches exactly one sibling; IDs are unique in the db, so
+      that can only fail when the feature doesn't exist, which is reported as derives_from_not_found)"""
+      report = { error_class: [] for error_class in [ 'missing_derives_from', 'polypeptide_id_count', 'derives_from_count',
+                                                      'derives_from_not_found', 'parent_count', 'multiple_polypeptides',
+                                                      'unexpected_type', 'not_annotated' ] }
+      def problem(error_class, feature, related, detail):
+         report[error_class].append( { 'feature': feature, 'related': related, 'detail': detail } )
+      conn = self.gffutils_db.conn
+      # in-memory indexes of feature types, and all ancestors of each feature (as gffutils parents() returns)
+      featuretype = {}
+      for this_id, this_type in conn.execute("SELECT id, featuretype FROM features"):
+         featuretype[this_id] = this_type
+      ancestors = {}
+      for parent, child in conn.execute("SELECT parent, child FROM relations"):
+         ancestors.setdefault(child, set()).add(parent)
+      # polypeptides, with the ID and Derives_from attributes parsed from the JSON held in the db
+      polypeptides_deriving_from = {}
+      for this_id, attributes in conn.execute("SELECT id, attributes FROM features WHERE featuretype = 'polypeptide'"):
+         attributes     = json.loads(attributes)
+         polypeptide_id = attributes.get('ID', [this_id])
+         if not 1 == len(polypeptide_id):
+            problem('polypeptide_id_count', this_id, None, "has "+str(len(polypeptide_id))+" IDs")
+            continue
+         polypeptide_id = polypeptide_id[0]
+         if not 'Derives_from' in attributes:
+            problem('missing_derives_from', polypeptide_id, None, "has no Derives_from attribute")
+            continue
+         if not 1 == len(attributes['Derives_from']):
+            problem('derives_from_count', polypeptide_id, None, "has "+str(len(attributes['Derives_from']))+" Derives_from values")
+            continue
+         derives_from = attributes['Derives_from'][0]
+         if self.only_transfer_anot_to_mRNA and not derives_from.endswith('mRNA'):
+            continue
+         if not derives_from in featuretype:
+            problem('derives_from_not_found', polypeptide_id, derives_from, "derives from a feature that doesn't exist")
+            continue
+         these_parents = ancestors.get(derives_from, set())
+         if not 1 == len(these_parents):
+            problem('parent_count', polypeptide_id, derives_from, "derives from a feature with "+str(len(these_parents))+" parents")
+            continue
+         if not featuretype[derives_from] in self.annotated_feature_types:
+            problem('unexpected_type', polypeptide_id, derives_from, "derives from a feature of unexpected type "+featuretype[derives_from])
+         polypeptides_deriving_from.setdefault(derives_from, []).append(polypeptide_id)
+      for derives_from, polypeptide_ids in polypeptides_deriving_from.items():
+         if len(polypeptide_ids) > 1:
+            problem('multiple_polypeptides', derives_from, ",".join(polypeptide_ids), str(len(polypeptide_ids))+" polypeptides derive from this feature")
+      for this_id, this_type in featuretype.items():
+         if this_type in self.annotated_feature_types and not this_id in polypeptides_deriving_from:
+            problem('not_annotated', this_id, None, this_type+" has no polypeptide deriving from it")
+      self.logger.info("relation report found "+str(sum( [len(problems) for problems in report.values()] ))+" problems")
+      return(report)
+
+
+
+   def diff_gff3(self, gff_filename, other_gff_filename):
+      """Pass paths of two GFF3 files (e.g. the input and output of gffmunger)
+      Compares the features in the files, regardless of the order they're in, by streaming through each once.
+      Features are matched by ID (features without an ID by type and location), and compared after normalising
+      their attributes, so differences in attribute order or escaping aren't reported.  Only a digest of each
+      attribute's values is kept for the features in the first file, so memory use depends on the number of
+      features, not the size of the files.
+      Returns dict of difference class -> list of differences, in the same form as relation_report():
+      - added:             feature is only in the second file
+      - removed:           feature is only in the first file
+      - changed:           feature is in both, but with different columns or attributes
+      - moved_attribute:   attribute (with the same values) was removed from one feature ('related') and added
+                           to another ('feature'), e.g. annotations moved from a polypeptide to an mRNA"""
+      column_names = ['seqid', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase']
+      report = { diff_class: [] for diff_class in ['added', 'removed', 'changed', 'moved_attribute'] }
+      def difference(diff_class, feature, related, detail):
+         report[diff_class].append( { 'feature': feature, 'related': related, 'detail': detail } )
+      # attributes removed from, and added to, features; matched up at the end to find the ones that moved
+      attributes_lost   = {}  # (attribute, digest of values) -> list of (ID, type)
+      attributes_gained = []  # (ID, type, attribute, digest of values)
+      def lose(this_id, columns, attribute_digests, keys):
+         for key in keys:
+            attributes_lost.setdefault( (key, attribute_digests[key]), [] ).append( (this_id, columns[2]) )
+      def gain(this_id, columns, attribute_digests, keys):
+         attributes_gained.extend( [ (this_id, columns[2], key, attribute_digests[key]) for key in keys ] )
+      # features in the first file: ID -> (columns 1-8, dict of attribute -> digest of values)
+      features = {}
+      for this_id, columns, attribute_digests in self.feature_digests(gff_filename):
+         features[this_id] = (columns, attribute_digests)
+      num_compared = 0
+      for this_id, columns, attribute_digests in self.feature_digests(other_gff_filename):
+         if not this_id in features:
+            difference('added', this_id, None, columns[2]+" only in "+other_gff_filename)
+            gain(this_id, columns, attribute_digests, attribute_digests.keys())
+            continue
+         num_compared += 1
+         old_columns, old_attribute_digests = features.pop(this_id)
+         if old_columns == columns and old_attribute_digests == attribute_digests:
+            continue
+         detail = []
+         changed_columns = [ name for name, old, new in zip(column_names, old_columns, columns) if old != new ]
+         if changed_columns:
+            detail.append("columns changed: "+",".join(changed_columns))
+         removed_keys = [ key for key in old_attribute_digests if not key in attribute_digests ]
+         added_keys   = [ key for key in attribute_digests if not key in old_attribute_digests ]
+         changed_keys = [ key for key in attribute_digests if key in old_attribute_digests and attribute_digests[key] != old_attribute_digests[key] ]
+         for description, keys in [ ('removed', removed_keys), ('added', added_keys), ('changed', changed_keys) ]:
+            if keys:
+               detail.append("attributes "+description+": "+",".join(keys))
+         difference('changed', this_id, None, columns[2]+" "+"; ".join(detail))
+         lose(this_id, old_columns, old_attribute_digests, removed_keys + changed_keys)
+         gain(this_id, columns,     attribute_digests,     added_keys + changed_keys)
+      # anything left wasn't in the second file
+      for this_id, (columns, attribute_digests) in features.items():
+         difference('removed', this_id, None, columns[2]+" only in "+gff_filename)
+         lose(this_id, columns, attribute_digests, attribute_digests.keys())
+      for this_id, this_type, key, digest in attributes_gained:
+         lost_from = attributes_lost.get( (key, digest) )
+         if lost_from:
+            from_id, from_type = lost_from.pop(0)
+            difference('moved_attribute', this_id, from_id, key+" moved from "+from_type+" to "+this_type)
+      self.logger.info("compared "+str(num_compared)+" features found in both files; "+
+                       ", ".join( [ str(len(differences))+" "+diff_class for diff_class, differences in report.items() ] ))
+      return(report)
+
+
+
+   def feature_digests(self, gff_filename):
+      """Pass path of GFF3 file (possibly gzipped)
+      Generator yielding, for each feature, its ID (or for features with no ID, type:seqid:start-end:strand),
+      a tuple of columns 1-8, and dict of attribute -> digest of its values (unescaped).  Lines with the same
+      ID (e.g. a CDS split over several lines) are told apart by adding the location to the ID."""
+      seen_ids = set()
+      with self.open_text_file(gff_filename) as f:
+         for line in f:
+            if line.startswith('#'):
+               if line.startswith('##FASTA'):
+                  break
+               continue
+            if line.startswith('>'):
+               break
+            columns = line.rstrip('\n').split('\t', 8)
+            if len(columns) < 9:
+               continue
+            attribute_digests = {}
+            this_id           = None
+            for this_attribute in columns[8].split(';'):
+               key, sep, value = this_attribute.partition('=')
+               if not key:
+                  continue
+               values = [ urllib.parse.unquote(v) for v in value.split(',') ]
+               if 'ID' == key:
+                  this_id = values[0]
+               # the digest only has to tell whether values differ, so 8 bytes of MD5 will do
+               attribute_digests[key] = hashlib.md5( "\n".join(values).encode('utf-8') ).digest()[:8]
+            location = columns[0]+':'+columns[3]+'-'+columns[4]+':'+columns[6]
+            if this_id is None:
+               this_id = columns[2]+':'+location
+            if this_id in seen_ids:
+               this_id += '@'+location
+            seen_ids.add(this_id)
+            yield( this_id, tuple( [ sys.intern(c) for c in columns[:3] ] + [ int(columns[3]), int(columns[4]) ] + columns[5:8] ), attribute_digests )
+
+
+
+   def write_report(self, report, report_filename=None):
+      """Pass report as returned by relation_report() or diff_gff3() (or several, combined in one dict), and
+      optionally name of the file to write it to
+      The report is written as JSON if the file name ends .json, otherwise as TSV (columns: class,
+      feature, related feature, detail).  Without a file name, the report is written as TSV to STDOUT if
+      no GFF3 is being written, otherwise to STDERR"""
+      if report_filename is not None:
+         handle = open(report_filename, "wt")
+      elif self.is_report_only():
+         handle = sys.stdout
+      else:
+         handle = sys.stderr
+      if report_filename is not None and report_filename.endswith('.json'):
+         json.dump(report, handle, indent=1)
+         handle.write("\n")
+      else:
+         handle.write("\t".join(['class', 'feature', 'related', 'detail'])+"\n")
+         for error_class, problems in report.items():
+            for this_problem in problems:
+               handle.write("\t".join( [ error_class, this_problem['feature'], this_problem['related'] or '.', this_problem['detail'] ] )+"\n")
+      if report_filename is not None:
+         handle.close()
+
+
+
    def export_gff3(self):
       """Writes GFF3 to output file (if previously specified) or STDOUT
       Uses metadata and (if present) FASTA from the GFF3 input; these should be unalatered
       Features are written from the gffutils database, so will refect whatever munging
       was done via the gffutils API
+      If the output file name ends .gz it is BGZF compressed (valid gzip), using compression_threads threads.
+      If tabix indexing was requested, the output is BGZF compressed, and the index is built as the
+      features are written.  Tabix can't index FASTA lines, so any FASTA is written to a separate
+      BGZF compressed file (see tabix_fasta_filename()) rather than after a ##FASTA directive.
+      If a snapshot directory was specified, a columnar binary snapshot of the features (see FeatureSnapshotWriter)
+      is written there too.
       """
       if self.gffutils_db is None:
          raise("Must import some GFF3 data before exporting")
       
-      if self.output_file is not None:
+      tabix_index = None
+      feature_sort = self.output_feature_sort
+      if self.output_file is not None and self.tabix_index:
+         self.logger.debug("Exporting BGZF compressed GFF3 to file "+ self.output_file)
+         handle         = BGZFWriter(self.output_file, threads=self.compression_threads)
+         tabix_index    = TabixIndex(self.tabix_index)
+         # tabix requires features grouped by seqid and sorted by start
+         feature_sort   = ['seqid', 'start']
+      elif self.output_file is not None and self.output_file.endswith('.gz'):
+         # BGZF is valid gzip, and its blocks can be compressed in parallel
+         self.logger.debug("Exporting GFF3 to file "+ self.output_file+", compressing with "+str(self.compression_threads)+" threads")
+         handle = BGZFWriter(self.output_file, threads=self.compression_threads)
+      elif self.output_file is not None:
          self.logger.debug("Exporting GFF3 to file "+ self.output_file)
          handle = open(self.output_file, "wt")
       else:
          self.logger.debug("Exporting GFF3 to STDOUT")
          handle = sys.stdout
 
+      snapshot = None
+      if self.snapshot_dir:
+         snapshot = FeatureSnapshotWriter()
+
+      if self.patch_export:
+         self.write_patched_input(handle)
+         handle.close()
+         # features aren't read from the db in patch mode, so need to be read for the snapshot
+         if snapshot is not None:
+            for this_feature in self.gffutils_db.all_features(order_by=feature_sort):
+               if self.attribute_values is not None:
+                  self.attribute_values.decode_feature(this_feature)
+               snapshot.add(this_feature)
+            self.write_snapshot(snapshot)
+         return(True)
+
       # write metadata
       handle.write( self.input_metadata )
       
       # write features
       num_features_written=0
-      for this_feature in self.gffutils_db.all_features(order_by=self.output_feature_sort):
+      for this_feature in self.gffutils_db.all_features(order_by=feature_sort):
          num_features_written+=1
-         handle.write( str(this_feature)+"\n" )
+         if self.attribute_values is not None:
+            self.attribute_values.decode_feature(this_feature)
+         feature_line = str(this_feature)+"\n"
+         if tabix_index is None:
+            handle.write( feature_line )
+         else:
+            # offsets aren't known until blocks are compressed, so index positions, and resolve them after closing
+            feature_beg = handle.position()
+            handle.write( feature_line )
+            tabix_index.add(this_feature.seqid, this_feature.start, this_feature.end, feature_beg, handle.position())
+         if snapshot is not None:
+            snapshot.add(this_feature, feature_line)
       self.logger.info("extracted and wrote "+str(num_features_written)+" features from gffutils db")
       if self.logger.isEnabledFor(logging.INFO):
          print("*** logging INFO ***")
       
       # write fasta
-      handle.write("##FASTA\n")
+      if tabix_index is None:
+         handle.write("##FASTA\n")
+         self.write_fasta(handle)
+         handle.close()
+      else:
+         handle.close()
+         tabix_index.resolve_offsets(handle.virtual_offset)
+         index_filename = self.output_file+'.'+self.tabix_index
+         self.logger.debug("Writing tabix index "+ index_filename)
+         tabix_index.write(index_filename)
+         fasta_filename = self.tabix_fasta_filename()
+         with BGZFWriter(fasta_filename, threads=self.compression_threads) as fasta_handle:
+            fasta_written = self.write_fasta(fasta_handle)
+         if fasta_written:
+            self.logger.info("FASTA written to separate file "+ fasta_filename)
+         else:
+            os.remove(fasta_filename)
+
+      if snapshot is not None:
+         self.write_snapshot(snapshot)
+      
+      return(True)
+
+
+
+   def write_snapshot(self, snapshot):
+      """Pass FeatureSnapshotWriter to which the exported features have been added; writes it to the snapshot directory"""
+      self.logger.debug("Writing feature snapshot to "+ self.snapshot_dir)
+      snapshot.write(self.snapshot_dir)
+      self.logger.info("wrote snapshot of "+str(snapshot.num_features)+" features to "+self.snapshot_dir)
+      
+
+
+   def write_patched_input(self, handle):
+      """Writes the GFF3 input to handle, line by line, verbatim except for the lines of features that were
+      modified by a munge command (see self.modified_feature_ids), which are written from the gffutils db.
+      So output is in input order, and everything that wasn't munged is byte-identical to the input.
+      If FASTA is being read from a separate file, it's written in place of any FASTA in the input."""
+      gff_filename = self.get_gff3_source()
+      self.logger.debug("Exporting in patch mode; "+str(len(self.modified_feature_ids))+" modified features will be written from the gffutils db")
+      # small map of modified features' IDs to their new lines
+      modified_lines = {}
+      for this_id in self.modified_feature_ids:
+         this_feature = self.gffutils_db[this_id]
+         if self.attribute_values is not None:
+            self.attribute_values.decode_feature(this_feature)
+         modified_lines[this_id] = str(this_feature)+"\n"
+      num_lines_replaced   = 0
+      in_fasta             = False
+      with self.open_text_file(gff_filename) as f:
+         for line in f:
+            if not in_fasta and (line.startswith('##FASTA') or line.startswith('>')):
+               in_fasta = True
+               # FASTA from a separate file replaces any in the input (as in extract_GFF3_components())
+               if self.fasta_file_arg is not None:
+                  break
+            if modified_lines and not in_fasta and not line.startswith('#'):
+               # ID is usually the first attribute, so look there before searching the whole column
+               attributes = line[line.rfind('\t')+1:].rstrip('\n')
+               if attributes.startswith('ID='):
+                  this_id = attributes[3:].split(';', 1)[0]
+               else:
+                  this_id = attributes.partition(';ID=')[2].split(';', 1)[0]
+               if '%' in this_id:
+                  this_id = urllib.parse.unquote(this_id)
+               if this_id in modified_lines:
+                  line = modified_lines[this_id]
+                  num_lines_replaced += 1
+            handle.write(line)
+      self.logger.info("copied GFF3 input, replacing "+str(num_lines_replaced)+" lines of modified features")
+      if self.fasta_file_arg is not None:
+         handle.write("##FASTA\n")
+         self.write_fasta(handle)
+
+
+
+   def write_fasta(self, handle):
+      """Writes FASTA to handle, either from a separate FASTA file or as read from the GFF3 input
+      Returns True if there was any FASTA to write"""
       if self.fasta_file_arg is not None:
          # using a separate FASTA file; write sequences from that file
          # if a sequence exists in the FASTA file but is not referenced in the input GFF3, it is *not* written
@@ -592,15 +1315,20 @@ class GFFMunger:
                self.logger.debug("Writing FASTA sequence "+str(num_seq_written)+": "+str(this_seq_id))
             except KeyError:
                self.logger.error("The GFF3 input included sequence "+this_seq_id+" which was not found in the FASTA input:  output will not include this in the FASTA")
-      else:
-         # using FASTA from the input GFF3 => write whatever was in the input (possibly nowt)
-         if self.input_fasta is not None:
-            handle.write( self.input_fasta )
-         
-      handle.close()
-      
-      return(True)
-      
+         return(num_seq_written > 0)
+      # using FASTA from the input GFF3 => write whatever was in the input (possibly nowt)
+      if self.input_fasta is not None:
+         handle.write( self.input_fasta )
+         return(True)
+      return(False)
+
+
+
+   def tabix_fasta_filename(self):
+      """Returns name of the file FASTA is written to when output is tabix indexed
+      This is the output file name with the .gff3.gz (or .gff.gz, or .gz) suffix replaced with .fasta.gz"""
+      return( re.sub(r'(\.gff3?)?\.gz$', '', self.output_file) + '.fasta.gz' )
+
 
 
    def gffutils_db_sequences(self):
@@ -1,5 +1,6 @@
 import os
 import argparse
+import re
 
 class InputTypes:
 
@@ -8,3 +9,17 @@ class InputTypes:
          raise argparse.ArgumentTypeError("must contain at least 3 chars")
          return False
       return whatever
+
+   def region(whatever):
+      """Parses seqid[:start-end] and returns (seqid, start, end); start and end are None if only seqid is given"""
+      match = re.match(r'^(.+?)(?::([0-9,]+)-([0-9,]+))?$', str(whatever))
+      if not match:
+         raise argparse.ArgumentTypeError("region must be seqid or seqid:start-end")
+      seqid, start, end = match.groups()
+      if start is None:
+         return( (seqid, None, None) )
+      start = int(start.replace(',',''))
+      end   = int(end.replace(',',''))
+      if start < 1 or end < start:
+         raise argparse.ArgumentTypeError("region start must be at least 1, and end must not be less than start")
+      return( (seqid, start, end) )
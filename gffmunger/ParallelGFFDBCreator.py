@@ -0,0 +1,143 @@
+import collections
+import concurrent.futures
+import gffutils
+import gffutils.create
+import gffutils.feature
+import gffutils.helpers
+import gffutils.iterators
+import gzip
+import re
+import sqlite3
+
+from gffutils import constants
+
+class ParallelGFFDBCreator(gffutils.create._GFFDBCreator):
+   """Creates a gffutils db from a GFF3 file, parsing the features on a pool of processes
+   Most of the time taken by gffutils.create_db() goes on parsing each line in Python (splitting the columns,
+   unescaping and splitting the attributes).  Here the input is read in chunks of whole lines, which are parsed
+   in parallel into rows ready to insert into the features table; a single writer inserts the rows, in input order,
+   with executemany().  Everything else (finding the dialect, creating tables and indexes, deriving second level
+   relations, autoincremented IDs for features without one) is done as gffutils does it, by the class this extends,
+   so the db is the same as gffutils.create_db() creates with id_spec 'ID' and merge_strategy 'error'."""
+
+   # size (in characters) of the chunks of input passed to each process
+   chunk_size     = 4 * 1024 * 1024
+   # gffutils stops reading GFF3 at a ##FASTA directive, or the first FASTA header
+   fasta_start    = re.compile(r'^(?:##FASTA\r?$|>)', re.MULTILINE)
+
+   def __init__(self, data, dbfn, processes=1, transform_attributes=None, **kwargs):
+      """Pass path of GFF3 file (possibly gzipped), name of the db file, the number of processes to parse the
+      input on, and optionally a function to be called with the attributes of each feature (dict of attribute ->
+      list of values) which may change them in place, e.g. AttributeValueDictionary.encode_attributes
+      Other keyword arguments are passed to gffutils (as for gffutils.create_db())"""
+      # gffutils finds the dialect from the first few features, and records only the directives before them
+      iterator = gffutils.iterators.DataIterator(data, checklines=10)
+      super().__init__( data, dbfn, id_spec='ID', merge_strategy='error', checklines=0,
+                        dialect=iterator.dialect, directives=iterator.directives, **kwargs )
+      self.processes             = processes
+      self.transform_attributes  = transform_attributes
+
+   @classmethod
+   def create_db(cls, data, dbfn, keep_order=False, sort_attribute_values=False, **kwargs):
+      """Pass path of GFF3 file, name of the db file, and options as for __init__() and gffutils.create_db()
+      Returns gffutils.FeatureDB"""
+      creator = cls(data, dbfn, **kwargs)
+      creator.create()
+      return( gffutils.FeatureDB(creator, keep_order=keep_order, sort_attribute_values=sort_attribute_values) )
+
+   def chunks(self):
+      """Generator yielding the GFF3 input in chunks of whole lines, up to any FASTA"""
+      if self._data.endswith('.gz'):
+         handle = gzip.open(self._data, 'rt')
+      else:
+         handle = open(self._data, 'r')
+      with handle:
+         partial_line = ''
+         while True:
+            block = handle.read(self.chunk_size)
+            if not block:
+               # last line, if it had no newline
+               lines = partial_line
+            else:
+               block          = partial_line + block
+               end_of_lines   = block.rfind('\n') + 1
+               lines          = block[:end_of_lines]
+               partial_line   = block[end_of_lines:]
+            fasta = self.fasta_start.search(lines)
+            if fasta is not None:
+               yield(lines[:fasta.start()])
+               return
+            if lines:
+               yield(lines)
+            if not block:
+               return
+
+   @staticmethod
+   def parse_chunk(lines, dialect, jsonify_attributes=True):
+      """Pass chunk of GFF3 lines, and the dialect (see gffutils.helpers._choose_dialect)
+      Returns list of features, each a list of the values to insert into the features table (with None as the ID
+      of features without an ID attribute, as that's autoincremented in input order) and list of the Parent IDs.
+      If jsonify_attributes is False, attributes are returned as dict, not the JSON to insert."""
+      features = []
+      for line in lines.split('\n'):
+         line = line.rstrip('\r')
+         if not line or line.startswith('#'):
+            continue
+         this_feature   = gffutils.feature.feature_from_line(line, dialect=dialect)
+         attributes     = this_feature.attributes
+         this_feature.id = None
+         if 'ID' in attributes:
+            if len(attributes['ID']) > 1:
+               raise ValueError("The ID field ID has more than one value but a single value is required for a primary key in the database")
+            if attributes['ID']:
+               this_feature.id = attributes['ID'][0]
+         row = list(this_feature.astuple())
+         if not jsonify_attributes:
+            row[9] = dict(attributes)
+         features.append( (row, list(attributes['Parent']) if 'Parent' in attributes else []) )
+      return(features)
+
+   def parsed_chunks(self):
+      """Generator yielding the features in each chunk of input, in input order, as returned by parse_chunk()"""
+      jsonify_attributes = self.transform_attributes is None
+      if self.processes < 2:
+         for lines in self.chunks():
+            yield( self.parse_chunk(lines, self.iterator.dialect, jsonify_attributes) )
+         return
+      with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as executor:
+         pending = collections.deque()
+         for lines in self.chunks():
+            pending.append( executor.submit(self.parse_chunk, lines, self.iterator.dialect, jsonify_attributes) )
+            # limit the number of chunks in memory
+            while len(pending) > 2 * self.processes:
+               yield( pending.popleft().result() )
+         while pending:
+            yield( pending.popleft().result() )
+
+   def _populate_from_lines(self, lines):
+      """Replaces the gffutils method that inserts features one at a time as they're parsed"""
+      c = self.conn.cursor()
+      self._drop_indexes()
+      num_features = 0
+      for features in self.parsed_chunks():
+         rows        = []
+         relations   = []
+         for row, parents in features:
+            if row[0] is None:
+               row[0] = self._increment_featuretype_autoid(row[3])
+            if self.transform_attributes is not None:
+               self.transform_attributes(row[9])
+               row[9] = gffutils.helpers._jsonify(row[9])
+            rows.append(row)
+            relations.extend( [ (parent, row[0]) for parent in parents ] )
+         try:
+            c.executemany(constants._INSERT, rows)
+         except sqlite3.IntegrityError:
+            # rows are inserted in order until one fails, so the number inserted gives the duplicate
+            num_inserted = self.conn.execute("SELECT count(*) FROM features").fetchone()[0] - num_features
+            raise ValueError("Duplicate ID "+rows[num_inserted][0])
+         c.executemany("INSERT OR IGNORE INTO relations VALUES (?, ?, 1)", relations)
+         num_features += len(rows)
+      if not num_features:
+         raise gffutils.exceptions.EmptyInputError("No lines parsed -- was an empty file provided?")
+      self.conn.commit()
@@ -0,0 +1,306 @@
+import gzip
+import struct
+
+from gffmunger.BGZFWriter import BGZFWriter
+
+class TabixIndex:
+   """Tabix index (.tbi or .csi) of a sorted, BGZF-compressed GFF3 file
+   Build the index by calling add() for each feature as it is written, in order, passing the virtual offsets
+   of the start and end of the feature line; then call write() to save it.  If the offsets aren't known
+   as the features are written (see BGZFWriter.position()), pass positions to add(), then convert them
+   with resolve_offsets() before writing.
+   An existing index can be loaded with TabixIndex.read(), and then fetch() used to read the lines in a region.
+   The binning scheme and linear index follow htslib, so the result can be used by tabix, JBrowse etc."""
+
+   # tabix header values for GFF (the same as `tabix -p gff`)
+   tabix_format      = 0            # generic TAB-delimited
+   tabix_col_seq     = 1
+   tabix_col_beg     = 4
+   tabix_col_end     = 5
+   tabix_meta_char   = '#'
+   tabix_skip        = 0
+
+   min_shift         = 14           # size of smallest bin, and of linear index windows, is 16kbp
+   tbi_depth         = 5            # fixed depth of .tbi binning, limiting coordinates to 2^29
+   csi_depth         = 6            # htslib default for .csi, allowing coordinates up to 2^32
+
+   def __init__(self, index_format='tbi'):
+      if not index_format in ['tbi', 'csi']:
+         raise ValueError("Index format must be 'tbi' or 'csi', not '"+str(index_format)+"'")
+      self.index_format = index_format
+      self.depth        = self.tbi_depth if 'tbi' == index_format else self.csi_depth
+      self.seqids       = []  # in file order
+      self.bins         = {}  # seqid -> {bin: [[chunk_beg, chunk_end], ...]}
+      self.linear       = {}  # seqid -> list of virtual offsets, one per 16kbp window
+      self.ref_stats    = {}  # seqid -> [first offset, last offset, number of features]
+      self.loffsets     = {}  # seqid -> {bin: offset}; only populated when a .csi index is read
+      self.last_start   = None
+
+   def meta_bin(self):
+      """Number of the pseudo-bin holding the per-reference summary"""
+      return( ((1 << (3 * self.depth + 3)) - 1) // 7 + 1 )
+
+   def max_position(self):
+      return( 1 << (self.min_shift + 3 * self.depth) )
+
+   def reg2bin(self, beg, end):
+      """Pass 0-based, half-open interval; returns the smallest bin containing it (htslib hts_reg2bin)"""
+      level       = self.depth
+      shift       = self.min_shift
+      first_bin   = ((1 << (3 * level)) - 1) // 7
+      end        -= 1
+      while level > 0:
+         if beg >> shift == end >> shift:
+            return( first_bin + (beg >> shift) )
+         level       -= 1
+         shift       += 3
+         first_bin   -= 1 << (3 * level)
+      return(0)
+
+   def first_window(self, bin):
+      """Returns index of the linear index window containing the start of a bin (htslib hts_bin_bot)"""
+      level = 0
+      b     = bin
+      while b:
+         level += 1
+         b = (b - 1) >> 3
+      return( (bin - ((1 << (3 * level)) - 1) // 7) << (3 * (self.depth - level)) )
+
+   def add(self, seqid, start, end, record_beg, record_end):
+      """Pass the seqid, start and end (1-based, inclusive, as in GFF3) of a feature, and the virtual offsets
+      of the start and end of the line it was written to.
+      Features must be added in the order they were written, grouped by seqid and sorted by start;
+      raises ValueError if they are not"""
+      beg = int(start) - 1
+      end = int(end)
+      if end > self.max_position():
+         raise ValueError("Feature on "+seqid+" ends at "+str(end)+", beyond the maximum position a ."+self.index_format+" index can hold; try a .csi index")
+      if end <= beg:
+         end = beg + 1
+      if not seqid in self.bins:
+         if seqid in self.seqids:
+            raise ValueError("Features must be grouped by seqid for tabix indexing, but "+seqid+" occurs again after other sequences")
+         self.seqids.append(seqid)
+         self.bins[seqid]        = {}
+         self.linear[seqid]      = []
+         self.ref_stats[seqid]   = [record_beg, record_end, 0]
+         self.last_start         = None
+      elif self.last_start is not None and beg < self.last_start:
+         raise ValueError("Features must be sorted by start for tabix indexing, but "+seqid+":"+str(start)+" follows a feature starting at "+str(self.last_start+1))
+      self.last_start = beg
+      # add to the bin; a chunk is extended to include the feature if it ends in the same BGZF block
+      # as the feature starts (as htslib does), as reading that block can't be avoided anyway
+      bin      = self.reg2bin(beg, end)
+      chunks   = self.bins[seqid].setdefault(bin, [])
+      if chunks and chunks[-1][1] >> 16 == record_beg >> 16:
+         chunks[-1][1] = record_end
+      else:
+         chunks.append( [record_beg, record_end] )
+      # linear index: offset of the first feature overlapping each window
+      linear         = self.linear[seqid]
+      first_window   = beg >> self.min_shift
+      last_window    = (end - 1) >> self.min_shift
+      if len(linear) <= last_window:
+         linear.extend( [None] * (last_window + 1 - len(linear)) )
+      for window in range(first_window, last_window+1):
+         if linear[window] is None:
+            linear[window] = record_beg
+      stats = self.ref_stats[seqid]
+      stats[1]  = record_end
+      stats[2] += 1
+
+   def resolve_offsets(self, resolve):
+      """Pass function that converts each offset passed to add() to a virtual offset (e.g. BGZFWriter.virtual_offset)
+      Converts all the offsets in the index"""
+      for seqid in self.seqids:
+         for chunks in self.bins[seqid].values():
+            for chunk in chunks:
+               chunk[0] = resolve(chunk[0])
+               chunk[1] = resolve(chunk[1])
+         self.linear[seqid]      = [ None if offset is None else resolve(offset) for offset in self.linear[seqid] ]
+         stats                   = self.ref_stats[seqid]
+         stats[0]                = resolve(stats[0])
+         stats[1]                = resolve(stats[1])
+
+   def finish_linear(self, seqid):
+      """Returns linear index for seqid, with empty windows filled from the previous window as htslib does"""
+      linear   = list(self.linear[seqid])
+      previous = self.ref_stats[seqid][0]
+      for window, offset in enumerate(linear):
+         if offset is None:
+            linear[window] = previous
+         previous = linear[window]
+      return(linear)
+
+   def tabix_header(self):
+      """Returns the tabix header: format, column numbers, meta char, lines skipped and sequence names"""
+      names = b''.join( [ seqid.encode('utf-8')+b'\0' for seqid in self.seqids ] )
+      return( struct.pack('<7i', self.tabix_format, self.tabix_col_seq, self.tabix_col_beg, self.tabix_col_end,
+                                 ord(self.tabix_meta_char), self.tabix_skip, len(names))
+              + names
+              )
+
+   def write(self, filename):
+      """Writes the index (BGZF compressed, as tabix does) to filename"""
+      if 'tbi' == self.index_format:
+         data = [ b'TBI\1', struct.pack('<i', len(self.seqids)), self.tabix_header() ]
+      else:
+         header   = self.tabix_header()
+         data     = [ b'CSI\1', struct.pack('<3i', self.min_shift, self.depth, len(header)), header, struct.pack('<i', len(self.seqids)) ]
+      for seqid in self.seqids:
+         linear   = self.finish_linear(seqid)
+         bins     = self.bins[seqid]
+         stats    = self.ref_stats[seqid]
+         data.append( struct.pack('<i', len(bins)+1) )
+         for bin in sorted(bins):
+            chunks = bins[bin]
+            if 'tbi' == self.index_format:
+               data.append( struct.pack('<Ii', bin, len(chunks)) )
+            else:
+               window   = self.first_window(bin)
+               loffset  = linear[window] if window < len(linear) else 0
+               data.append( struct.pack('<IQi', bin, loffset, len(chunks)) )
+            for chunk_beg, chunk_end in chunks:
+               data.append( struct.pack('<QQ', chunk_beg, chunk_end) )
+         # pseudo-bin with start and end offsets for the sequence, and counts of mapped/unmapped features
+         if 'tbi' == self.index_format:
+            data.append( struct.pack('<Ii', self.meta_bin(), 2) )
+         else:
+            data.append( struct.pack('<IQi', self.meta_bin(), 0, 2) )
+         data.append( struct.pack('<4Q', stats[0], stats[1], stats[2], 0) )
+         if 'tbi' == self.index_format:
+            data.append( struct.pack('<i', len(linear)) )
+            data.append( struct.pack('<'+str(len(linear))+'Q', *linear) )
+      # number of features with no coordinates (always none in GFF3)
+      data.append( struct.pack('<Q', 0) )
+      with BGZFWriter(filename) as handle:
+         handle.write_bytes( b''.join(data) )
+
+   @classmethod
+   def read(cls, filename):
+      """Reads a .tbi or .csi index file (such as written by write(), or by tabix)
+      Returns a TabixIndex object"""
+      with gzip.open(filename, 'rb') as f:
+         data = f.read()
+      pos = 0
+      def unpack(fmt):
+         nonlocal pos
+         values = struct.unpack_from('<'+fmt, data, pos)
+         pos   += struct.calcsize('<'+fmt)
+         return(values)
+      magic = data[:4]
+      pos   = 4
+      if b'TBI\1' == magic:
+         index = cls('tbi')
+         (n_ref,) = unpack('i')
+      elif b'CSI\1' == magic:
+         index = cls('csi')
+         index.min_shift, index.depth, l_aux = unpack('3i')
+         aux_end = pos + l_aux
+      else:
+         raise ValueError(filename+" is not a .tbi or .csi index")
+      (index.tabix_format, index.tabix_col_seq, index.tabix_col_beg, index.tabix_col_end, meta_char, index.tabix_skip, l_nm) = unpack('7i')
+      index.tabix_meta_char = chr(meta_char)
+      index.seqids   = [ name.decode('utf-8') for name in data[pos:pos+l_nm].split(b'\0')[:-1] ]
+      pos           += l_nm
+      if 'csi' == index.index_format:
+         pos = aux_end
+         (n_ref,) = unpack('i')
+      if n_ref != len(index.seqids):
+         raise ValueError(filename+" has "+str(n_ref)+" indexed sequences but "+str(len(index.seqids))+" sequence names")
+      meta_bin = index.meta_bin()
+      for seqid in index.seqids:
+         bins     = index.bins[seqid]     = {}
+         loffsets = index.loffsets[seqid] = {}
+         (n_bin,) = unpack('i')
+         for b in range(n_bin):
+            if 'tbi' == index.index_format:
+               bin, n_chunk = unpack('Ii')
+            else:
+               bin, loffset, n_chunk = unpack('IQi')
+               loffsets[bin] = loffset
+            chunks = [ list(unpack('QQ')) for c in range(n_chunk) ]
+            if bin == meta_bin:
+               index.ref_stats[seqid] = [chunks[0][0], chunks[0][1], chunks[1][0]]
+            else:
+               bins[bin] = chunks
+         if 'tbi' == index.index_format:
+            (n_intv,) = unpack('i')
+            index.linear[seqid] = list(unpack(str(n_intv)+'Q'))
+         else:
+            index.linear[seqid] = []
+      return(index)
+
+   def reg2bins(self, beg, end):
+      """Pass 0-based, half-open interval; returns list of all bins that may hold features overlapping it (htslib reg2bins)"""
+      bins        = []
+      end        -= 1
+      first_bin   = 0
+      shift       = self.min_shift + 3 * self.depth
+      for level in range(self.depth+1):
+         bins.extend( range(first_bin + (beg >> shift), first_bin + (end >> shift) + 1) )
+         first_bin  += 1 << (3 * level)
+         shift      -= 3
+      return(bins)
+
+   def min_offset(self, seqid, beg):
+      """Returns the virtual offset before which no feature overlapping position beg (0-based) can start"""
+      if 'tbi' == self.index_format:
+         linear = self.linear[seqid]
+         if not linear:
+            return(0)
+         window = beg >> self.min_shift
+         return( linear[window] if window < len(linear) else linear[-1] )
+      # .csi has no linear index, but bins have the equivalent offset; use the lowest bin at position beg that exists
+      loffsets = self.loffsets.get(seqid, {})
+      bin      = self.reg2bin(beg, beg+1)
+      while bin > 0 and not bin in loffsets:
+         bin = (bin - 1) >> 3
+      return( loffsets.get(bin, 0) )
+
+   def chunks(self, seqid, start, end):
+      """Pass seqid, start and end (1-based, inclusive)
+      Returns sorted, merged list of [beg, end] virtual offsets of the file chunks that contain all features overlapping the region"""
+      if not seqid in self.bins:
+         return([])
+      beg      = max(int(start) - 1, 0)
+      end      = min(int(end), self.max_position())
+      if end <= beg:
+         return([])
+      min_off  = self.min_offset(seqid, beg)
+      chunks   = []
+      for bin in self.reg2bins(beg, end):
+         for chunk_beg, chunk_end in self.bins[seqid].get(bin, []):
+            if chunk_end > min_off:
+               chunks.append( [chunk_beg, chunk_end] )
+      chunks.sort()
+      merged = []
+      for chunk in chunks:
+         if merged and chunk[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], chunk[1])
+         else:
+            merged.append(chunk)
+      return(merged)
+
+   def fetch(self, reader, seqid, start, end):
+      """Pass a BGZFReader for the indexed file, seqid, start and end (1-based, inclusive)
+      Generator yielding each line (without the newline) of a feature overlapping the region"""
+      col_seq = self.tabix_col_seq - 1
+      col_beg = self.tabix_col_beg - 1
+      col_end = self.tabix_col_end - 1
+      for chunk_beg, chunk_end in self.chunks(seqid, start, end):
+         reader.seek(chunk_beg)
+         while reader.tell() < chunk_end:
+            line = reader.readline()
+            if not line:
+               break
+            if line.startswith(self.tabix_meta_char):
+               continue
+            columns = line.rstrip('\n').split('\t')
+            if columns[col_seq] != seqid:
+               continue
+            if int(columns[col_beg]) > int(end):
+               break
+            if int(columns[col_end]) < int(start):
+               continue
+            yield( line.rstrip('\n') )
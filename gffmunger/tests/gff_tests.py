@@ -4,7 +4,10 @@ import gffutils
 import uuid
 import warnings
 
+from gffmunger.AttributeValueDictionary import AttributeValueDictionary
+from gffmunger.FeatureTraversal import FeatureTraversal
 from gffmunger.GFFMunger import GFFMunger
+from gffmunger.ParallelGFFDBCreator import ParallelGFFDBCreator
 
 test_modules_dir        = os.path.dirname(   os.path.realpath( __file__ ) )
 data_dir                = os.path.join(      test_modules_dir, 'data' )
@@ -15,6 +18,7 @@ test_gff_db_file        = '/tmp/gffutils_test.<uid>.db'
 #sample_gff_gene_id      = 'PF3D7_0100100' # use with SAMPLE.gff3
 sample_gff_gene_id      = '13J3.01' # use with SMALL_SAMPLE.gff3
 sample_gff_featuretypes = ['gene', 'mRNA', 'CDS', 'polypeptide'] 
+sample_gff_gene_cluster = ['pseudogene', 'pseudogenic_transcript', 'pseudogenic_exon'] # sample_gff_gene_id and descendants
 
 expected_db_class          = gffutils.FeatureDB
 expected_feature_class     = gffutils.Feature
@@ -99,3 +103,67 @@ class GFF_Tests(unittest.TestCase):
       """test separation of GFF3 file with FASTA, into metadata, features and FASTA data"""
       self.gffmunger.extract_GFF3_components(test_gff_and_fasta_file)    
       self.assertIsNotNone(self.gffmunger.input_fasta)
+
+   def test_050_attribute_value_encoding(self):
+      """test dictionary encoding of attribute values round trips, and repeated values share one code"""
+      if (not self.db_available):
+         self.skipTest('no db available')
+      dictionary = AttributeValueDictionary()
+      for this_feature in self.test_gff_db.all_features():
+         original = str(this_feature)
+         dictionary.encode_feature(this_feature)
+         # relations must not be encoded, whatever else is
+         for key in ['ID', 'Parent', 'Derives_from']:
+            for this_id in this_feature.attributes.get(key, []):
+               self.assertFalse(this_id.startswith(dictionary.code_prefix))
+         self.assertEqual(original, str(dictionary.decode_feature(this_feature)))
+      long_value = 'term=conserved hypothetical protein;'
+      self.assertEqual(dictionary.encode(long_value), dictionary.encode(str(long_value)))
+      self.assertIs(dictionary.decode(dictionary.encode(long_value)), dictionary.decode(dictionary.encode(long_value)))
+      dictionary.save(self.test_gff_db.conn)
+      reloaded = AttributeValueDictionary.load(self.test_gff_db.conn)
+      self.assertEqual(dictionary.values, reloaded.values)
+
+   def test_060_feature_traversal(self):
+      """test per-feature and per-cluster transforms are run in one traversal, and changes written back once"""
+      munger = GFFMunger(None)
+      munger.import_gff3(test_gff_file)
+      traversal   = FeatureTraversal(munger.gffutils_db)
+      clusters    = {}
+      def mark_feature(this_feature, traversal):
+         this_feature.attributes['traversed'] = ['feature']
+         traversal.modified(this_feature)
+      def mark_cluster(cluster, traversal):
+         clusters[cluster[0].id] = [this_feature.featuretype for this_feature in cluster]
+         for this_feature in cluster:
+            # features changed by the per-feature transform should be seen as changed
+            self.assertEqual(['feature'], this_feature.attributes.get('traversed'))
+            this_feature.attributes['traversed'].append('cluster')
+            traversal.modified(this_feature)
+      finished = []
+      traversal.register(mark_feature)
+      traversal.register_cluster(mark_cluster, finish=finished.append)
+      modified_ids = traversal.run()
+      self.assertEqual([traversal], finished)
+      self.assertEqual(sample_gff_gene_cluster, clusters[sample_gff_gene_id])
+      self.assertIn(sample_gff_gene_id, modified_ids)
+      self.assertEqual(['feature', 'cluster'], munger.gffutils_db[sample_gff_gene_id].attributes.get('traversed'))
+      munger.clean_up()
+
+   def test_070_parallel_import(self):
+      """test GFF3 parsed in chunks on several processes gives the same db as gffutils"""
+      db_filename = str(test_gff_db_file).replace('<uid>',uuid.uuid4().hex)
+      default_chunk_size = ParallelGFFDBCreator.chunk_size
+      # small chunks, so the input is split into many; the input has the same features as test_gff_file, followed by
+      # FASTA, which should not be parsed
+      ParallelGFFDBCreator.chunk_size = 10000
+      try:
+         parallel_db = ParallelGFFDBCreator.create_db(test_gff_and_fasta_file, db_filename, processes=3, force=True, keep_order=True)
+      finally:
+         ParallelGFFDBCreator.chunk_size = default_chunk_size
+      for query in [ "SELECT rowid, * FROM features ORDER BY rowid",
+                     "SELECT * FROM relations ORDER BY parent, child, level",
+                     "SELECT * FROM directives",
+                     ]:
+         self.assertEqual( [tuple(row) for row in self.test_gff_db.conn.execute(query)], [tuple(row) for row in parallel_db.conn.execute(query)] )
+      os.remove(db_filename)
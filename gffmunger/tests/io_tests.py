@@ -1,13 +1,19 @@
 import argparse
 import gffutils
+import gzip
+import json
 import logging
 import os
 import pyfaidx
+import shutil
 import unittest
 import uuid
 import warnings
 
+from gffmunger.FeatureSnapshotReader import FeatureSnapshotReader
+from gffmunger.FeatureSnapshotWriter import FeatureSnapshotWriter
 from gffmunger.GFFMunger import GFFMunger
+from gffmunger.InputTypes import InputTypes
 
 test_modules_dir  = os.path.dirname(   os.path.realpath( __file__ ) )
 data_dir          = os.path.join(      test_modules_dir, 'data' )
@@ -24,6 +30,10 @@ broken_gff_file   = os.path.join(      data_dir,         'SMALL_SAMPLE_BROKEN_RE
 expected_num_input_lines      = 2082
 expected_num_metadata_lines   = 43
 
+# features related to region TPH25N7:12000-12001: two overlapping genes, each with transcript, exon and polypeptide, and a repeat
+expected_region_gene_id       = 'H25N7.02'
+expected_num_region_features  = 9
+
 class IO_Tests(unittest.TestCase):
    
    @classmethod
@@ -86,6 +96,282 @@ class IO_Tests(unittest.TestCase):
       newmunger.clean_up()
 
 
+   def test_025_null_command_io(self):
+      """check the null command imports the input and writes all of it as output"""
+      null_munger = GFFMunger( None )
+      null_munger.commands          = ['null']
+      null_munger.novalidate        = True
+      null_munger.input_file_arg    = test_gff_no_fasta
+      null_munger.output_file       = self.output_file
+      self.assertFalse(null_munger.is_report_only())
+      self.assertFalse(null_munger.is_text_only())
+      with warnings.catch_warnings():
+         warnings.filterwarnings("ignore", "unclosed file <_io\.TextIOWrapper", ResourceWarning, "gffutils", 668 )
+         null_munger.run()
+      warnings.resetwarnings()
+      with gzip.open(test_gff_no_fasta, 'rt') as f:
+         input_features = [ line for line in f.read().splitlines() if not line.startswith('#') and '\t' in line ]
+      with open(null_munger.output_file) as f:
+         output_features = [ line for line in f.read().splitlines() if not line.startswith('#') and '\t' in line ]
+      self.assertEqual(len(input_features), len(output_features))
+      os.remove(null_munger.output_file)
+
+   def test_030_gff3_tabix_io(self):
+      """check BGZF compressed, tabix indexed output; FASTA should be written to a separate file"""
+      for index_format, magic in [('tbi', b'TBI\1'), ('csi', b'CSI\1')]:
+         tabix_munger = GFFMunger( None )
+         tabix_munger.input_file_arg   = test_gff_file
+         tabix_munger.output_file      = self.output_file+'.gz'
+         tabix_munger.tabix_index      = index_format
+         with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", "unclosed file <_io\.TextIOWrapper", ResourceWarning, "gffutils", 668 )
+            tabix_munger.import_gff3()
+            tabix_munger.extract_GFF3_components()
+            tabix_munger.move_polypeptide_annotations()
+         warnings.resetwarnings()
+         self.assertTrue(tabix_munger.export_gff3())
+         index_file = tabix_munger.output_file+'.'+index_format
+         fasta_file = tabix_munger.tabix_fasta_filename()
+         with gzip.open(index_file, 'rb') as f:
+            self.assertEqual(magic, f.read(4))
+         with gzip.open(tabix_munger.output_file, 'rt') as f:
+            output_lines = f.read().splitlines()
+         self.assertNotIn('##FASTA', output_lines)
+         self.assertFalse(any( [line.startswith('>') for line in output_lines] ))
+         with gzip.open(fasta_file, 'rt') as f:
+            self.assertTrue(f.readline().startswith('>'))
+         for filename in [tabix_munger.output_file, index_file, fasta_file]:
+            os.remove(filename)
+         tabix_munger.clean_up()
+
+   def test_035_gff3_compressed_io(self):
+      """check .gz output is compressed on multiple threads, and decompresses to the same as uncompressed output"""
+      output = {}
+      for suffix, threads in [('', 1), ('.gz', 3)]:
+         gz_munger = GFFMunger( None )
+         gz_munger.input_file_arg      = test_gff_file
+         gz_munger.output_file         = self.output_file+suffix
+         gz_munger.compression_threads = threads
+         with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", "unclosed file <_io\.TextIOWrapper", ResourceWarning, "gffutils", 668 )
+            gz_munger.import_gff3()
+            gz_munger.extract_GFF3_components()
+         warnings.resetwarnings()
+         self.assertTrue(gz_munger.export_gff3())
+         with gz_munger.open_text_file(gz_munger.output_file) as f:
+            output[suffix] = f.read()
+         os.remove(gz_munger.output_file)
+         gz_munger.clean_up()
+      self.assertEqual(output[''], output['.gz'])
+
+   def test_038_gff3_patch_io(self):
+      """check patch mode output is identical to the input, except for lines of features that were munged"""
+      with gzip.open(test_gff_file, 'rt') as f:
+         input_lines = f.read().splitlines()
+      patch_munger = GFFMunger( None )
+      patch_munger.input_file_arg   = test_gff_file
+      patch_munger.output_file      = self.output_file
+      patch_munger.patch_export     = True
+      with warnings.catch_warnings():
+         warnings.filterwarnings("ignore", "unclosed file <_io\.TextIOWrapper", ResourceWarning, "gffutils", 668 )
+         patch_munger.import_gff3()
+         patch_munger.extract_GFF3_components()
+         self.assertTrue(patch_munger.export_gff3())
+         with open(patch_munger.output_file) as f:
+            self.assertEqual(input_lines, f.read().splitlines())
+         patch_munger.move_polypeptide_annotations()
+      warnings.resetwarnings()
+      self.assertTrue(patch_munger.export_gff3())
+      with open(patch_munger.output_file) as f:
+         output_lines = f.read().splitlines()
+      self.assertEqual(len(input_lines), len(output_lines))
+      for input_line, output_line in zip(input_lines, output_lines):
+         if input_line != output_line:
+            self.assertIn(output_line.split('\t')[2], ['polypeptide'] + patch_munger.annotated_feature_types)
+      os.remove(patch_munger.output_file)
+      patch_munger.clean_up()
+      # with a separate FASTA file, its sequences replace the FASTA in the input
+      with open(test_fasta_file) as f:
+         num_sequences = len( [ line for line in f if line.startswith('>') ] )
+      fasta_munger = GFFMunger( None )
+      fasta_munger.input_file_arg   = test_gff_file
+      fasta_munger.fasta_file_arg   = test_fasta_file
+      fasta_munger.output_file      = self.output_file
+      fasta_munger.patch_export     = True
+      with warnings.catch_warnings():
+         warnings.filterwarnings("ignore", "unclosed file <_io\.TextIOWrapper", ResourceWarning, "gffutils", 668 )
+         warnings.filterwarnings("ignore", "unclosed file <_io\.FileIO",   ResourceWarning, "six",      581 )
+         fasta_munger.import_gff3()
+         fasta_munger.import_fasta()
+         fasta_munger.extract_GFF3_components()
+         self.assertTrue(fasta_munger.export_gff3())
+      warnings.resetwarnings()
+      with open(fasta_munger.output_file) as f:
+         output_lines = f.read().splitlines()
+      self.assertEqual(1,              output_lines.count('##FASTA'))
+      self.assertEqual(num_sequences,  len( [ line for line in output_lines if line.startswith('>') ] ))
+      self.assertEqual(input_lines[:input_lines.index('##FASTA')], output_lines[:output_lines.index('##FASTA')])
+      os.remove(fasta_munger.output_file)
+      fasta_munger.clean_up()
+
+   @unittest.skipUnless(FeatureSnapshotWriter.available(), "numpy is needed for feature snapshots")
+   def test_039_gff3_snapshot_io(self):
+      """check the feature snapshot written with the GFF3 output holds the same features"""
+      snapshot_munger = GFFMunger( None )
+      snapshot_munger.input_file_arg   = test_gff_file
+      snapshot_munger.output_file      = self.output_file
+      snapshot_munger.snapshot_dir     = self.output_file+'.snapshot'
+      with warnings.catch_warnings():
+         warnings.filterwarnings("ignore", "unclosed file <_io\.TextIOWrapper", ResourceWarning, "gffutils", 668 )
+         snapshot_munger.import_gff3()
+         snapshot_munger.extract_GFF3_components()
+         snapshot_munger.move_polypeptide_annotations()
+      warnings.resetwarnings()
+      self.assertTrue(snapshot_munger.export_gff3())
+      with open(snapshot_munger.output_file) as f:
+         feature_lines = [ line.split('\t') for line in f.read().splitlines() if not line.startswith('#') and '\t' in line ]
+      snapshot = FeatureSnapshotReader(snapshot_munger.snapshot_dir)
+      self.assertEqual(len(feature_lines), len(snapshot))
+      for n, columns in enumerate(feature_lines):
+         self.assertEqual(columns[0],        snapshot.decoded('seqid', n))
+         self.assertEqual(columns[2],        snapshot.decoded('featuretype', n))
+         self.assertEqual(int(columns[3]),   snapshot.start[n])
+         self.assertEqual(int(columns[4]),   snapshot.end[n])
+         self.assertEqual(columns[6],        snapshot.strand[n].decode())
+         self.assertEqual(columns[8],        snapshot.feature_attributes(n))
+      del snapshot
+      shutil.rmtree(snapshot_munger.snapshot_dir)
+      os.remove(snapshot_munger.output_file)
+      snapshot_munger.clean_up()
+
+   def test_040_gff3_region_io(self):
+      """check munging of a region, using a gffutils db of the input as an index, and using a tabix index"""
+      self.assertEqual(('TPH25N7', 12000, 12001),  InputTypes.region('TPH25N7:12,000-12,001'))
+      self.assertEqual(('TPH25N7', None, None),    InputTypes.region('TPH25N7'))
+      region_munger = GFFMunger( None )
+      region_munger.input_file_arg  = test_gff_no_fasta
+      region_munger.region          = ('TPH25N7', 12000, 12001)
+      region_munger.import_gff3_region()
+      # all features related to those overlapping the region should be imported, including those beyond the region
+      self.assertEqual(expected_num_region_features, len(list(region_munger.gffutils_db.all_features())))
+      self.assertEqual(expected_region_gene_id,      region_munger.gffutils_db[expected_region_gene_id].id)
+      region_index_db = test_gff_no_fasta + region_munger.region_index_suffix
+      self.assertTrue(os.path.exists(region_index_db))
+      # write tabix indexed output, and use that as input for a region
+      region_munger.tabix_index     = 'tbi'
+      region_munger.output_file     = self.output_file+'.gz'
+      region_munger.extract_GFF3_components()
+      region_munger.move_polypeptide_annotations()
+      region_munger.export_gff3()
+      region_munger.clean_up()
+      tabix_munger = GFFMunger( None )
+      tabix_munger.input_file_arg   = region_munger.output_file
+      tabix_munger.region           = ('TPH25N7', None, None)
+      tabix_munger.import_gff3_region()
+      self.assertEqual(expected_num_region_features, len(list(tabix_munger.gffutils_db.all_features())))
+      tabix_munger.clean_up()
+      # a region with no features is an error, whichever index is used
+      for input_file, empty_region in [(region_munger.output_file, ('NOSUCHSEQ', 1, 100)), (test_gff_no_fasta, ('TPH25N7', 900000, 900100))]:
+         empty_munger = GFFMunger( None )
+         empty_munger.input_file_arg   = input_file
+         empty_munger.region           = empty_region
+         with self.assertLogs('gffmunger.GFFMunger', level='CRITICAL') as logs:
+            with self.assertRaises(SystemExit) as context:
+               empty_munger.import_gff3_region()
+         self.assertEqual(1, context.exception.code)
+         self.assertIn('No features found in region', logs.output[0])
+      for filename in [region_index_db, region_munger.output_file, region_munger.output_file+'.tbi']:
+         os.remove(filename)
+      # a long feature overlapping the region, but unrelated to it, shouldn't widen the region read
+      seqid, start, end = region_munger.region
+      with gzip.open(test_gff_no_fasta, 'rt') as f:
+         seqid_lines = [ line.rstrip('\n') for line in f if line.startswith(seqid+'\t') ]
+      seqid_lines.insert(0, "\t".join([seqid, 'chado', 'chromosome', '1', '200000', '.', '+', '.', 'ID='+seqid]))
+      def fetch(seqid, start, end):
+         fetched_spans.append( (start, end) )
+         return( [ line for line in seqid_lines if int(line.split('\t')[3]) <= end and int(line.split('\t')[4]) >= start ] )
+      def find_parents(ids):
+         return( set( [ this_id for this_id in ids for line in seqid_lines if 'Parent='+this_id in line ] ) )
+      # it overlaps the region, so is kept; but without find_parents it has to be assumed to have children
+      for this_find_parents, whole_sequence_read in [(find_parents, False), (None, True)]:
+         fetched_spans = []
+         related_lines = tabix_munger.features_related_to_region(fetch, seqid, start, end, find_parents=this_find_parents)
+         self.assertEqual(expected_num_region_features+1, len(related_lines))
+         self.assertIn('chromosome', [ line.split('\t')[2] for line in related_lines ])
+         self.assertEqual(whole_sequence_read, (1, 200000) in fetched_spans)
+
+   def test_045_relation_report(self):
+      """checks relation_report finds all the broken relations in one pass, and writes the report"""
+      report_munger = GFFMunger( None )
+      report_munger.commands = ['relation_report']
+      report_munger.import_gff3(broken_gff_file)
+      report = report_munger.relation_report()
+      self.assertEqual( ['H25N7.09:pep'],   [p['feature'] for p in report['missing_derives_from']] )
+      self.assertEqual( ['13J3.17:pep'],    [p['feature'] for p in report['derives_from_not_found']] )
+      self.assertEqual( ['H25N7.05:mRNA'],  [p['feature'] for p in report['multiple_polypeptides']] )
+      self.assertEqual( ['13J3.17:mRNA', 'H25N7.09:mRNA'], sorted([p['feature'] for p in report['not_annotated']]) )
+      report_file = self.output_file+'.json'
+      report_munger.write_report(report, report_file)
+      with open(report_file) as f:
+         self.assertEqual(report, json.load(f))
+      os.remove(report_file)
+      report_munger.clean_up()
+
+   def test_046_multiple_polypeptides(self):
+      """checks annotations are moved from only one of several polypeptides deriving from the same mRNA"""
+      polypeptide_ids   = ['H25N7.05:pep', 'H25N7.05.01:pep', 'H25N7.05.02:pep']
+      move_munger       = GFFMunger( None )
+      move_munger.import_gff3(broken_gff_file)
+      with self.assertLogs('gffmunger.GFFMunger', level='ERROR') as logs:
+         move_munger.move_polypeptide_annotations()
+      moved = [ this_id for this_id in polypeptide_ids if not 'translation' in move_munger.gffutils_db[this_id].attributes ]
+      self.assertEqual(1, len(moved))
+      not_moved_errors = [ message for message in logs.output if 'already has the annotations of polypeptide '+moved[0] in message ]
+      self.assertEqual(2, len(not_moved_errors))
+      self.assertIn('translation', move_munger.gffutils_db['H25N7.05:mRNA'].attributes)
+      move_munger.clean_up()
+
+   def test_047_logged_features_decoded(self):
+      """checks features in log messages show attribute values, not the codes they're encoded as in the db"""
+      log_munger = GFFMunger( None )
+      log_munger.import_gff3(broken_gff_file)
+      self.assertIsNotNone(log_munger.attribute_values)
+      with self.assertLogs('gffmunger.GFFMunger', level='ERROR') as logs:
+         log_munger.move_polypeptide_annotations()
+      feature_errors = [ message for message in logs.output if 'without a Derives_from attribute' in message ]
+      self.assertEqual(1, len(feature_errors))
+      self.assertIn('H25N7.09:pep', feature_errors[0])
+      self.assertIn('translation=', feature_errors[0])
+      for message in logs.output:
+         self.assertNotIn(log_munger.attribute_values.code_prefix, message)
+         self.assertNotIn('%1F', message)
+      log_munger.clean_up()
+
+   def test_048_gff3_diff(self):
+      """checks diff finds no differences between copies of the GFF3, and finds the annotations moved by munging"""
+      diff_munger = GFFMunger( None )
+      diff_munger.input_file_arg = test_gff_file
+      diff_munger.output_file    = self.output_file
+      report = diff_munger.diff_gff3(test_gff_file, test_gff_no_fasta)
+      self.assertEqual( [], sum(report.values(), []) )
+      with warnings.catch_warnings():
+         warnings.filterwarnings("ignore", "unclosed file <_io\.TextIOWrapper", ResourceWarning, "gffutils", 668 )
+         diff_munger.import_gff3()
+         diff_munger.extract_GFF3_components()
+         diff_munger.move_polypeptide_annotations()
+      warnings.resetwarnings()
+      diff_munger.export_gff3()
+      report = diff_munger.diff_gff3(test_gff_file, diff_munger.output_file)
+      self.assertEqual( [], report['added'] + report['removed'] )
+      changed_types = set( [ p['detail'].split(' ')[0] for p in report['changed'] ] )
+      self.assertTrue( changed_types <= set(['polypeptide'] + diff_munger.annotated_feature_types) )
+      self.assertTrue( report['moved_attribute'] )
+      for this_move in report['moved_attribute']:
+         self.assertTrue( this_move['detail'].split(' ')[3] == 'polypeptide' )
+         self.assertIn( this_move['detail'].split(' ')[5], diff_munger.annotated_feature_types )
+      os.remove(diff_munger.output_file)
+      diff_munger.clean_up()
+
    def test_050_gff_error_handling(self):
       """checks handling of non-fatal errors encountered in GFF"""
       yet_another_munger = GFFMunger( None )
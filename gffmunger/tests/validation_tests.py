@@ -1,7 +1,12 @@
+import gzip
 import unittest
 import os
+import pyfaidx
 import subprocess
+import uuid
 
+from gffmunger.BGZFWriter import BGZFWriter
+from gffmunger.FASTAScanner import FASTAScanner
 from gffmunger.GFFMunger import GFFMunger
 
 test_modules_dir  = os.path.dirname(   os.path.realpath( __file__ ) )
@@ -10,6 +15,10 @@ test_gff_file     = os.path.join(      data_dir,         'SMALL_SAMPLE.gff3.gz'
 bad_gff_file      = os.path.join(      data_dir,         'NOT_GFF.gff3' )
 test_fasta_file   = os.path.join(      data_dir,         'SMALL_SAMPLE.fasta' )
 bad_fasta_file    = os.path.join(      data_dir,         'NOT_FASTA.fasta' )
+broken_gff_file   = os.path.join(      data_dir,         'SMALL_SAMPLE_BROKEN_RELATIONS.gff3.gz' )
+
+# the one broken Derives_from reference in broken_gff_file
+expected_dangling_reference = (142, 'Derives_from', '13J3_BROKE_LINK_FOR_TESTING.17:mRNA')
 
 gt_test_arg = '-help' # something guaranteed to be OK with any working install of genometools
 
@@ -42,3 +51,67 @@ class Validator_Tests(unittest.TestCase):
    def test_040_gt_invalid_fasta_fails(self):
       """check GFFMunger.validate_FASTA fails an invalid FASTA file"""
       self.assertFalse( self.gffmunger.validate_FASTA(bad_fasta_file, silent=True) ) # silence validation errors, which are expected
+
+   def test_050_prescan_finds_dangling_references(self):
+      """check GFFMunger.prescan_gff3 reports references to IDs that don't exist"""
+      self.assertEqual( {'duplicate_ids': {}, 'dangling_references': []}, self.gffmunger.prescan_gff3(test_gff_file) )
+      report = self.gffmunger.prescan_gff3(broken_gff_file, silent=True)
+      self.assertEqual( [expected_dangling_reference], report['dangling_references'] )
+
+   def test_060_prescan_fails_duplicate_ids(self):
+      """check GFFMunger.prescan_gff3 raises ValueError for duplicate IDs"""
+      duplicated_gff_file = __file__+'.'+uuid.uuid4().hex+'.gff3'
+      with gzip.open(test_gff_file, 'rt') as f:
+         lines = f.readlines()
+      first_feature = [line for line in lines if not line.startswith('#')][0]
+      with open(duplicated_gff_file, 'w') as f:
+         f.writelines(lines + [first_feature])
+      try:
+         with self.assertRaises(ValueError):
+            self.gffmunger.prescan_gff3(duplicated_gff_file, silent=True)
+      finally:
+         os.remove(duplicated_gff_file)
+
+   def test_070_fasta_validation_checks_every_record(self):
+      """check GFFMunger.validate_FASTA finds problems anywhere in a FASTA file"""
+      broken_fasta = { 'bad_alphabet':    ">seq1\nACGT\nAC\n>seq2\nACGT\nAXGT\nA\n",
+                       'duplicate_id':    ">seq1\nACGT\n>seq2\nACGT\n>seq1\nACGT\n",
+                       'no_id':           ">seq1\nACGT\n> seq2\nACGT\n",
+                       'line_lengths':    ">seq1\nACGT\n>seq2\nACGT\nACG\nACGT\n",
+                       'blank_line':      ">seq1\nACGT\n\nACGT\n",
+                       }
+      fasta_file = __file__+'.'+uuid.uuid4().hex+'.fasta'
+      try:
+         for problem, fasta in broken_fasta.items():
+            with open(fasta_file, 'w') as f:
+               f.write(fasta)
+            self.assertFalse( self.gffmunger.validate_FASTA(fasta_file, silent=True), problem )
+            self.assertFalse( os.path.exists(fasta_file+'.fai'), problem )
+            scanner = FASTAScanner(fasta_file)
+            self.assertFalse( scanner.scan() )
+            self.assertEqual( 1, len(scanner.errors), problem )
+      finally:
+         os.remove(fasta_file)
+
+   def test_080_fasta_validation_builds_index(self):
+      """check GFFMunger.validate_FASTA writes an index of BGZF compressed FASTA that pyfaidx can use"""
+      fasta_file = __file__+'.'+uuid.uuid4().hex+'.fasta.gz'
+      with open(test_fasta_file) as f:
+         sequences = [ (header[1:], sequence) for header, sequence in zip(*[iter(f.read().splitlines())]*2) ]
+      # small blocks and wrapped lines, so sequences span blocks
+      with BGZFWriter(fasta_file) as f:
+         f.max_block_size = 1000
+         for seqid, sequence in sequences:
+            f.write( ">"+seqid+"\n"+"".join( [ sequence[n:n+60]+"\n" for n in range(0, len(sequence), 60) ] ) )
+      try:
+         self.assertTrue( self.gffmunger.validate_FASTA(fasta_file) )
+         self.assertTrue( os.path.exists(fasta_file+'.fai') )
+         self.assertTrue( os.path.exists(fasta_file+'.gzi') )
+         fasta = pyfaidx.Fasta(fasta_file)
+         for seqid, sequence in sequences:
+            self.assertEqual( sequence, str(fasta[seqid]) )
+         fasta.close()
+      finally:
+         for filename in [fasta_file, fasta_file+'.fai', fasta_file+'.gzi']:
+            if os.path.exists(filename):
+               os.remove(filename)
@@ -25,11 +25,15 @@ setup(
     test_suite='nose.collector',
     tests_require=['nose >= 1.3'],
     install_requires=[
-         'biopython >= 1.68',
+         'biopython >= 1.73', # not imported by gffmunger, but pyfaidx needs it to read BGZF compressed FASTA
          #'pyfastaq >= 3.12.0'
          'gffutils', # no version requirements known; tested with 0.9
+         'pyfaidx',  # no version requirements known; tested with 0.9.0.4
          'pyyaml'    # no version requirements known; tested with 5.1.1
        ],
+    extras_require={
+         'snapshot': ['numpy'] # for writing/reading feature snapshots
+       },
     license='GPLv3',
     classifiers=[
         'Development Status :: 4 - Beta',